@@ -1,12 +1,17 @@
 # -*- coding: utf8 -*-
 
 """
-    astar.py - A* algorithm implementation
+    astar.py - A* algorithm implementation (and its variants)
 """
 
 from math import sqrt
-import scipy
-import scipy.signal
+from array import array
+from heapq import heappush, heappop
+from collections import OrderedDict
+import numpy as np
+import scipy.ndimage
+import scipy.sparse
+import scipy.sparse.csgraph
 
 class Cell(object):
 
@@ -64,7 +69,39 @@ class Cell(object):
         return "Cell [{}, {}] | Reachable : {}".format(self.x, self.y, self.reachable)
 
 
+def gridGraph(walkable):
+    """ Sparse adjacency matrix of the walkable cells of a grid (8-connected, same costs as A*).
+    Cell (x, y) is the node y*width + x. """
+    h, w = walkable.shape
+    indexes = np.arange(h*w).reshape(h, w)
+    rows, cols, costs = [], [], []
+
+    for dx, dy, cost in AStar.moves:
+        # Cells (x, y) and their neighbours (x + dx, y + dy), when they're both in the grid
+        src = (slice(max(0, -dy), h - max(0, dy)), slice(max(0, -dx), w - max(0, dx)))
+        dst = (slice(max(0, dy), h - max(0, -dy)), slice(max(0, dx), w - max(0, -dx)))
+        linked = walkable[src] & walkable[dst]
+
+        rows.append(indexes[src][linked])
+        cols.append(indexes[dst][linked])
+        costs.append(np.empty(linked.sum()))
+        costs[-1].fill(cost)
+
+    return scipy.sparse.csr_matrix((np.concatenate(costs), (np.concatenate(rows), np.concatenate(cols))),
+                                   shape=(h*w, h*w))
+
+
+class SearchCancelled(Exception):
+    """ Raised (through DiscreteMap.checkpoint) when a search is stopped before its end """
+    pass
+
+
 class DiscreteMap:
+    # Search algorithms
+    astar, jps, hpa, thetastar, dstarlite, flowfield = range(6)
+
+    # Number of flow fields kept in cache
+    def_flowFields = 8
 
     def __init__(self, svgMap, division=5, radius=100):
 
@@ -74,44 +111,72 @@ class DiscreteMap:
         self.height = int(svgMap.height/division)
         self.division = division
 
-        # Open and closed list, used for A* algorithm
-        self.ol = set()
-        self.cl = set()
-
         self.svgMap = svgMap
 
-        # The initial grid (only taking into account the shapes, not their perimeter)
-        self.initgrid = [[Cell(x, y) for x in xrange(self.width)] for y in xrange(self.height)]
+        # The cell (x, y) represents the point ( (x + 0.5)*division, (y + 0.5)*division )
+        xs = ((np.arange(self.width) + 0.5) * self.division).astype(int)
+        ys = ((np.arange(self.height) + 0.5) * self.division).astype(int)
+
+        # The initial grid (only taking into account the shapes, not their perimeter) : True if reachable
+        self.initgrid = ~self.svgMap.rasterize(xs, ys)
 
         # The grid that'll take into account the shapes' 'perimeter' (to avoid collisions with the car)
-        self.grid = [[Cell(x, y) for x in xrange(self.width)] for y in xrange(self.height)]
+        self.grid = self.initgrid.copy()
 
-        for y in xrange(self.height):
-            for x in xrange(self.width):
-                # The cell (x, y) will represent the point ( (x + 0.5)*division, (y + 0.5)*division )
-                xi, yi = (x + 0.5)*self.division, (y + 0.5)*self.division
-                obstacle = self.svgMap.isObstacle(xi, yi)
-                self.initgrid[y][x].reachable = not obstacle
-                self.grid[y][x].reachable = not obstacle
+        # Incremented every time the grid's reachability changes
+        self.version = 0
 
+        self.updateClearance()
         self.setRadius(radius)
 
+        # Search engines (and the one used by default)
+        self.engines = {DiscreteMap.astar: AStar(self), DiscreteMap.jps: JumpPointSearch(self),
+                        DiscreteMap.hpa: HierarchicalSearch(self), DiscreteMap.thetastar: ThetaStar(self),
+                        DiscreteMap.dstarlite: DStarLite(self), DiscreteMap.flowfield: FlowFieldSearch(self)}
+        self.algorithm = DiscreteMap.astar
+
+        # Called regularly (with the number of expanded cells) while searching : returns False to cancel
+        self.monitor = None
+
+        # Flow fields of the current version, by goal (least recently used first)
+        self.flowFields = OrderedDict()
+        self.flowFieldsVersion = self.version
+
+        # Free cells and connected areas (of the initial grid and of the current one), by version
+        self.freeSpace = dict()
+        self.freeSpaceVersion = self.version
+
+    def updateClearance(self):
+        """ Computes the distance (in cells) from each cell to the closest obstacle.
+        Inflating the obstacles by any radius is then just a threshold on this field. """
+        if self.initgrid.all():
+            self.clearance = np.empty(self.initgrid.shape)
+            self.clearance.fill(np.inf)
+        else:
+            self.clearance = scipy.ndimage.distance_transform_edt(self.initgrid)
+
     def setRadius(self, radius):
-        """ Sets as unreachable the cells that have an obstacle in a certain radius """
-        r = radius / self. division
-        # Avoiding nil radiuses
-        r = max(1, r)
+        """ Sets as unreachable the cells that have an obstacle in a certain radius
+        (the radius is the car's size, so the obstacles are inflated by half of it) """
+        self.radius = radius
+        r = radius / float(self.division)
 
-        # 1 : Unreachable ; 0 : Reachable
-        car = scipy.array([[1 for i in xrange(r)] for j in xrange(r)])
-        grid = scipy.array([[0 if self.initgrid[i][j].reachable else 1 for j in xrange(
-            self.width)] for i in xrange(self.height)])
+        self.grid = self.clearance > r / 2.
+        self.version += 1
 
-        result = scipy.signal.fftconvolve(grid, car, 'same')
+    def setReachable(self, cells, reachable):
+        """ Sets cells (out of the map's shapes : an obstacle met on the way, ...) reachable or not.
+        The engines and the caches follow the new version of the grid. setRadius computes the grid from
+        the shapes again, and so discards these changes. """
+        grid = self.grid.copy()
+        for cell in cells:
+            if 0 <= cell.x < self.width and 0 <= cell.y < self.height:
+                grid[cell.y, cell.x] = reachable
 
-        for i in xrange(self.height):
-            for j in xrange(self.width):
-                self.grid[i][j].reachable = int(result[i][j]) == 0
+        self.grid = grid
+        self.version += 1
+        self.flowFields.clear()
+        self.freeSpace.clear()
 
     def neighbours(self, cell, radius=1, unreachables=False, diagonal=True):
         neighbours = set()
@@ -119,80 +184,83 @@ class DiscreteMap:
             for j in xrange(-radius, radius + 1):
                 x = cell.x + j
                 y = cell.y + i
-                if 0 <= y < self.height and 0 <= x < self.width and (self.grid[y][x].reachable or unreachables) and (diagonal or (x == cell.x or y == cell.y)):
-                    neighbours.add(self.grid[y][x])
+                if 0 <= y < self.height and 0 <= x < self.width and (self.grid[y, x] or unreachables) and (diagonal or (x == cell.x or y == cell.y)):
+                    neighbours.add(Cell(x, y, reachable=bool(self.grid[y, x])))
 
         return neighbours
 
-    def search(self, begin, goal):
+    def search(self, begin, goal, algorithm=None):
 
         if goal.x not in range(self.width) or goal.y not in range(self.height):
             print "Goal is out of bound"
             return []
-        elif not self.grid[begin.y][begin.x].reachable:
+        elif not self.grid[begin.y, begin.x]:
             print "Beginning is unreachable"
             return []
-        elif not self.grid[goal.y][goal.x].reachable:
+        elif not self.grid[goal.y, goal.x]:
             print "Goal is unreachable"
             return []
         else:
-            # We intialize the closed and open list...
-            cl = set()
-            ol = set()
-            ol.add(begin)
-
-            # ... and the path's beginning
-            begin.g = 0
-            begin.h = begin.diagonalDistance(goal)
-            begin.f = begin.g + begin.h
+            if algorithm is None:
+                algorithm = self.algorithm
+            return self.engines[algorithm].search(begin, goal)
 
-            while len(ol) > 0:
-                curCell = min(ol, key=lambda cell: cell.f)
+    def checkpoint(self, expanded):
+        """ Called by the engines every few expansions, to report their progress and let the search be
+        cancelled (the current search then raises SearchCancelled) """
+        if self.monitor is not None and not self.monitor(expanded):
+            raise SearchCancelled()
 
-                if curCell == goal:
-                    # We get the path to the current cell, minus the first cell
-                    path = curCell.path()[1:]
+    def freeCells(self, reachable=False, around=None):
+        """ Flat indexes (y*width + x) of the cells out of the obstacles (or reachable by the car, with 'reachable').
+        With 'around' (a cell), only the ones in the same connected area. """
+        if self.freeSpaceVersion != self.version:
+            self.freeSpace.clear()
+            self.freeSpaceVersion = self.version
 
-                    # Before returning the result, we clear the grid (from all weights, parents, ...)
-                    self.clear()
+        if reachable not in self.freeSpace:
+            grid = self.grid if reachable else self.initgrid
+            labels, count = scipy.ndimage.label(grid, structure=np.ones((3, 3)))
+            self.freeSpace[reachable] = (np.flatnonzero(grid), labels.ravel())
+        cells, labels = self.freeSpace[reachable]
 
-                    return path
+        if around is None:
+            return cells
 
-                # We remove the current cell from the open list and add it to the closed list
-                ol.remove(curCell)
-                cl.add(curCell)
+        label = labels[around.y*self.width + around.x] if 0 <= around.x < self.width and 0 <= around.y < self.height else 0
+        if label == 0:
+            # Not in a free area
+            return np.empty(0, dtype=int)
+        return cells[labels[cells] == label]
 
-                for neighbor in self.neighbours(curCell):
-                    gScore = curCell.g + curCell.distance(neighbor)
+    def flowField(self, goal):
+        """ The distance and direction field to a goal (computed once per goal and grid's version) """
+        if self.flowFieldsVersion != self.version:
+            self.flowFields.clear()
+            self.flowFieldsVersion = self.version
 
-                    if neighbor in cl:
-                        if gScore >= neighbor.g:
-                            continue
+        key = (goal.x, goal.y)
+        field = self.flowFields.pop(key, None)
+        if field is None:
+            field = FlowField(self, goal)
+            if len(self.flowFields) >= DiscreteMap.def_flowFields:
+                self.flowFields.popitem(last=False)
+        self.flowFields[key] = field
 
-                    if neighbor not in ol or gScore < neighbor.g:
-                        neighbor.parent = curCell
-                        neighbor.g = gScore
-                        neighbor.f = neighbor.g + neighbor.diagonalDistance(goal)
-                        if neighbor not in ol:
-                            ol.add(neighbor)
+        return field
 
-            self.clear()
-            return []
-
-    def clear(self):
-        for line in self.grid:
-            for cell in line:
-                cell.f = 0
-                cell.h = 0
-                cell.g = 0
-                cell.parent = None
+    def isAnyAngle(self, algorithm=None):
+        """ True if the algorithm's paths are made of waypoints (not of adjacent cells) """
+        if algorithm is None:
+            algorithm = self.algorithm
+        return self.engines[algorithm].anyAngle
 
     def display(self):
 
         dispMatrix = [[' ' for x in range(self.width)] for y in range(self.height)]
         for x in range(self.width):
             for y in range(self.height):
-                if self.grid[y][x].reachable:
+                if self.grid[y, x]:
                     dispMatrix[y][x] = ' '
                 else:
                     dispMatrix[y][x] = '#'
@@ -210,3 +278,830 @@ class DiscreteMap:
             # End of line
             print "|\n",
         print '|' + '__'*(1 + self.width) + '|'
+
+
+class AStar(object):
+    """
+    A* search on a DiscreteMap's grid.
+    The search's state (g-scores, parents, open/closed flags) is kept in flat arrays indexed by cell,
+    and the open list is a binary heap. Instead of clearing the arrays after each query, entries are
+    stamped with the query's 'generation' : an entry from an older generation is considered empty.
+    Paths are optimal, but among equally short ones, the cells chosen depend on the ties' order.
+    """
+
+    # Moves to the 8 neighbours : (dx, dy, cost)
+    moves = [(dx, dy, sqrt(dx**2 + dy**2)) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx != 0 or dy != 0]
+
+    # Paths are made of adjacent cells
+    anyAngle = False
+
+    def __init__(self, discreteMap):
+        self.map = discreteMap
+
+        # The grid is padded with a border of unreachable cells (no need to check bounds)
+        self.stride = discreteMap.width + 2
+        n = self.stride * (discreteMap.height + 2)
+
+        self.g = array('d', [0.]) * n
+        self.parent = array('i', [-1]) * n
+        self.opened = array('i', [0]) * n
+        self.closed = array('i', [0]) * n
+        self.generation = 0
+
+        self.neighbours = [(dy*self.stride + dx, cost) for dx, dy, cost in AStar.moves]
+
+        # Reachability (a flat list), updated when the map's version changes
+        self.walkable = None
+        self.version = None
+
+        # Number of cells expanded by the last query
+        self.expanded = 0
+
+    def index(self, x, y):
+        return (y + 1)*self.stride + x + 1
+
+    def coordinates(self, index):
+        y, x = divmod(index, self.stride)
+        return x - 1, y - 1
+
+    def update(self):
+        if self.version != self.map.version:
+            padded = np.zeros((self.map.height + 2, self.stride), dtype=bool)
+            padded[1:-1, 1:-1] = self.map.grid
+            self.walkable = padded.ravel().tolist()
+            self.version = self.map.version
+
+    def heuristic(self, index, goalX, goalY):
+        # Diagonal distance (same as Cell.diagonalDistance)
+        y, x = divmod(index, self.stride)
+        dx, dy = abs(x - goalX), abs(y - goalY)
+        return 1.4 * min(dx, dy) + abs(dx - dy)
+
+    def search(self, begin, goal):
+        """ Same contract as DiscreteMap.search : the list of cells leading from begin (excluded) to goal """
+        self.update()
+        self.generation += 1
+        self.expanded = 0
+
+        gen = self.generation
+        g, parent, opened, closed = self.g, self.parent, self.opened, self.closed
+        walkable, neighbours, heuristic = self.walkable, self.neighbours, self.heuristic
+
+        start, target = self.index(begin.x, begin.y), self.index(goal.x, goal.y)
+        goalY, goalX = divmod(target, self.stride)
+
+        g[start] = 0.
+        parent[start] = -1
+        opened[start] = gen
+
+        # Entries : (f, h, cell) ; on equal f, the cell closest to the goal is expanded first
+        h = heuristic(start, goalX, goalY)
+        openList = [(h, h, start)]
+
+        while openList:
+            f, h, current = heappop(openList)
+
+            if closed[current] == gen:
+                # An outdated entry (the cell was reached again with a better score)
+                continue
+
+            if current == target:
+                return self.path(start, target)
+
+            closed[current] = gen
+            self.expanded += 1
+            if not self.expanded & 1023:
+                self.map.checkpoint(self.expanded)
+            gCurrent = g[current]
+
+            for offset, cost in neighbours:
+                neighbour = current + offset
+                if not walkable[neighbour] or closed[neighbour] == gen:
+                    continue
+
+                gScore = gCurrent + cost
+                if opened[neighbour] != gen or gScore < g[neighbour]:
+                    g[neighbour] = gScore
+                    parent[neighbour] = current
+                    opened[neighbour] = gen
+                    h = heuristic(neighbour, goalX, goalY)
+                    heappush(openList, (gScore + h, h, neighbour))
+
+        return []
+
+    def path(self, start, target):
+        path = []
+        current = target
+        while current != start:
+            x, y = self.coordinates(current)
+            path.append(Cell(x, y))
+            current = self.parent[current]
+
+        return path[::-1]
+
+
+class JumpPointSearch(AStar):
+    """
+    Jump Point Search : A* on a uniform-cost grid, where symmetric paths are pruned by 'jumping'
+    along straight and diagonal lines until a cell with a forced neighbour (or the goal) is met.
+    Only those jump points go through the open list. The returned path is expanded back into
+    adjacent cells, so it can be used like A*'s.
+    """
+
+    def jump(self, current, dx, dy, target):
+        """ The first jump point met going from current in the (dx, dy) direction (-1 if there's none) """
+        walkable, s = self.walkable, self.stride
+        step = dy*s + dx
+
+        while True:
+            current += step
+            if not walkable[current]:
+                return -1
+            if current == target:
+                return current
+
+            if dx and dy:
+                # Forced neighbours when moving diagonally...
+                if (not walkable[current - dx] and walkable[current - dx + dy*s]) or \
+                   (not walkable[current - dy*s] and walkable[current + dx - dy*s]):
+                    return current
+                # ... or a jump point reachable by moving straight
+                if self.jump(current, dx, 0, target) >= 0 or self.jump(current, 0, dy, target) >= 0:
+                    return current
+            elif dx:
+                if (not walkable[current + s] and walkable[current + dx + s]) or \
+                   (not walkable[current - s] and walkable[current + dx - s]):
+                    return current
+            else:
+                if (not walkable[current + 1] and walkable[current + 1 + dy*s]) or \
+                   (not walkable[current - 1] and walkable[current - 1 + dy*s]):
+                    return current
+
+    def directions(self, current):
+        """ Directions to explore from current, pruned according to the direction we came from """
+        if self.parent[current] < 0:
+            return [(dx, dy) for dx, dy, cost in AStar.moves]
+
+        walkable, s = self.walkable, self.stride
+        py, px = divmod(self.parent[current], s)
+        y, x = divmod(current, s)
+        dx, dy = cmp(x, px), cmp(y, py)
+
+        if dx and dy:
+            directions = [(dx, dy), (dx, 0), (0, dy)]
+            if not walkable[current - dx]:
+                directions.append((-dx, dy))
+            if not walkable[current - dy*s]:
+                directions.append((dx, -dy))
+        elif dx:
+            directions = [(dx, 0)]
+            if not walkable[current + s]:
+                directions.append((dx, 1))
+            if not walkable[current - s]:
+                directions.append((dx, -1))
+        else:
+            directions = [(0, dy)]
+            if not walkable[current + 1]:
+                directions.append((1, dy))
+            if not walkable[current - 1]:
+                directions.append((-1, dy))
+
+        return directions
+
+    def search(self, begin, goal):
+        self.update()
+        self.generation += 1
+        self.expanded = 0
+
+        gen = self.generation
+        g, parent, opened, closed = self.g, self.parent, self.opened, self.closed
+        heuristic, s = self.heuristic, self.stride
+
+        start, target = self.index(begin.x, begin.y), self.index(goal.x, goal.y)
+        goalY, goalX = divmod(target, s)
+
+        g[start] = 0.
+        parent[start] = -1
+        opened[start] = gen
+
+        h = heuristic(start, goalX, goalY)
+        openList = [(h, h, start)]
+
+        while openList:
+            f, h, current = heappop(openList)
+
+            if closed[current] == gen:
+                continue
+
+            if current == target:
+                return self.path(start, target)
+
+            closed[current] = gen
+            self.expanded += 1
+            if not self.expanded & 1023:
+                self.map.checkpoint(self.expanded)
+            y, x = divmod(current, s)
+
+            for dx, dy in self.directions(current):
+                jumpPoint = self.jump(current, dx, dy, target)
+                if jumpPoint < 0 or closed[jumpPoint] == gen:
+                    continue
+
+                # Jump points are on a straight or diagonal line from the current cell
+                jy, jx = divmod(jumpPoint, s)
+                distX, distY = abs(jx - x), abs(jy - y)
+                gScore = g[current] + max(distX, distY) + (sqrt(2) - 1) * min(distX, distY)
+
+                if opened[jumpPoint] != gen or gScore < g[jumpPoint]:
+                    g[jumpPoint] = gScore
+                    parent[jumpPoint] = current
+                    opened[jumpPoint] = gen
+                    h = heuristic(jumpPoint, goalX, goalY)
+                    heappush(openList, (gScore + h, h, jumpPoint))
+
+        return []
+
+    def path(self, start, target):
+        # Filling the gaps between consecutive jump points
+        jumpPoints = [target]
+        while jumpPoints[-1] != start:
+            jumpPoints.append(self.parent[jumpPoints[-1]])
+        jumpPoints.reverse()
+
+        path = []
+        for origin, end in zip(jumpPoints[:-1], jumpPoints[1:]):
+            x, y = self.coordinates(origin)
+            endX, endY = self.coordinates(end)
+            dx, dy = cmp(endX, x), cmp(endY, y)
+            while (x, y) != (endX, endY):
+                x, y = x + dx, y + dy
+                path.append(Cell(x, y))
+
+        return path
+
+
+class HierarchicalSearch(object):
+    """
+    Hierarchical pathfinding (HPA*) : the grid is split into square clusters, linked by 'entrances'
+    on their borders. The distances between the entrances of each cluster are computed once (for
+    a given reachability of the grid), which makes an abstract graph. A long query is answered on
+    this small graph, then refined into cells with the shortest paths stored for each cluster.
+    Paths are near-optimal (they cross the clusters' borders at the entrances only).
+    """
+
+    # Clusters' side (in cells), and minimal length of an opening to get two entrances
+    def_clusterSize = 16
+    wideEntrance = 6
+
+    anyAngle = False
+
+    def __init__(self, discreteMap, clusterSize=def_clusterSize):
+        self.map = discreteMap
+        self.clusterSize = clusterSize
+        self.version = None
+
+        # Searches inside a single cluster are done with A*
+        self.astar = AStar(discreteMap)
+
+        # Number of abstract nodes expanded by the last query
+        self.expanded = 0
+
+    def cluster(self, x, y):
+        return (y // self.clusterSize) * self.clustersX + x // self.clusterSize
+
+    def clusterBounds(self, cluster):
+        y0, x0 = divmod(cluster, self.clustersX)
+        x0, y0 = x0 * self.clusterSize, y0 * self.clusterSize
+        return x0, y0, min(x0 + self.clusterSize, self.map.width), min(y0 + self.clusterSize, self.map.height)
+
+    def update(self):
+        """ Builds the abstract graph (only when the grid's reachability changed).
+        Can be cancelled between two clusters (it's then built again from scratch by the next search) """
+        if self.version == self.map.version:
+            return
+
+        grid = self.map.grid
+        cs = self.clusterSize
+        self.clustersX = (self.map.width + cs - 1) // cs
+        self.clustersY = (self.map.height + cs - 1) // cs
+
+        # Abstract nodes : their cell, and the node's id for each cell
+        self.nodeCells = []
+        self.nodes = dict()
+        self.edges = []
+
+        def node(x, y):
+            if (x, y) not in self.nodes:
+                self.nodes[(x, y)] = len(self.nodeCells)
+                self.nodeCells.append((x, y))
+                self.edges.append([])
+            return self.nodes[(x, y)]
+
+        def addEntrances(cells, otherCells):
+            # cells and otherCells : two facing lines of cells, on each side of a border
+            open = [grid[y, x] and grid[oy, ox] for (x, y), (ox, oy) in zip(cells, otherCells)]
+            i = 0
+            while i < len(open):
+                if not open[i]:
+                    i += 1
+                    continue
+                start = i
+                while i < len(open) and open[i]:
+                    i += 1
+
+                # An entrance in the middle of the opening, or one at each end if it's wide
+                if i - start < HierarchicalSearch.wideEntrance:
+                    transitions = [(start + i - 1) // 2]
+                else:
+                    transitions = [start, i - 1]
+
+                for t in transitions:
+                    a, b = node(*cells[t]), node(*otherCells[t])
+                    self.edges[a].append((b, 1.))
+                    self.edges[b].append((a, 1.))
+
+        # Entrances between horizontally and vertically adjacent clusters
+        for border in xrange(cs, self.map.width, cs):
+            for y0 in xrange(0, self.map.height, cs):
+                ys = range(y0, min(y0 + cs, self.map.height))
+                addEntrances([(border - 1, y) for y in ys], [(border, y) for y in ys])
+        for border in xrange(cs, self.map.height, cs):
+            for x0 in xrange(0, self.map.width, cs):
+                xs = range(x0, min(x0 + cs, self.map.width))
+                addEntrances([(x, border - 1) for x in xs], [(x, border) for x in xs])
+
+        # Shortest paths inside each cluster, from each of its entrances
+        self.trees = [None] * len(self.nodeCells)
+        self.clusterNodes = [[] for i in xrange(self.clustersX * self.clustersY)]
+        for n, (x, y) in enumerate(self.nodeCells):
+            self.clusterNodes[self.cluster(x, y)].append(n)
+
+        for cluster, nodes in enumerate(self.clusterNodes):
+            self.map.checkpoint(cluster)
+            if not nodes:
+                continue
+
+            dist, trees = self.clusterPaths(cluster, [self.nodeCells[n] for n in nodes])
+            for i, a in enumerate(nodes):
+                self.trees[a] = trees[i]
+                for j, b in enumerate(nodes):
+                    if a != b and np.isfinite(dist[i, j]):
+                        self.edges[a].append((b, dist[i, j]))
+
+        self.version = self.map.version
+
+    def clusterPaths(self, cluster, sources):
+        """ Dijkstra inside a cluster, from the given cells.
+        Returns the distances from each source to each other source, and the shortest path trees. """
+        x0, y0, x1, y1 = self.clusterBounds(cluster)
+        width = x1 - x0
+        graph = gridGraph(self.map.grid[y0:y1, x0:x1])
+
+        local = [(y - y0)*width + x - x0 for x, y in sources]
+        dist, predecessors = scipy.sparse.csgraph.dijkstra(graph, indices=local, return_predecessors=True)
+
+        return dist[:, local], predecessors
+
+    def treePath(self, cluster, tree, cell):
+        """ Cells from cell to the root of a shortest path tree of cluster (root excluded) """
+        x0, y0, x1, y1 = self.clusterBounds(cluster)
+        width = x1 - x0
+        path = []
+        current = (cell[1] - y0)*width + cell[0] - x0
+        while tree[current] >= 0:
+            y, x = divmod(current, width)
+            path.append((x + x0, y + y0))
+            current = tree[current]
+
+        return path
+
+    def search(self, begin, goal):
+        self.update()
+        self.expanded = 0
+
+        beginCluster, goalCluster = self.cluster(begin.x, begin.y), self.cluster(goal.x, goal.y)
+        if max(abs(begin.x - goal.x), abs(begin.y - goal.y)) < 2*self.clusterSize:
+            # Short queries are cheap, and the abstraction's detours would cost more there
+            return self.astar.search(begin, goal)
+
+        # Linking the beginning and the goal to their clusters' entrances
+        beginNodes, goalNodes = self.clusterNodes[beginCluster], self.clusterNodes[goalCluster]
+        beginDist, beginTree = self.clusterPaths(beginCluster, [(begin.x, begin.y)] +
+                                                 [self.nodeCells[n] for n in beginNodes])
+        goalDist, goalTree = self.clusterPaths(goalCluster, [(goal.x, goal.y)] +
+                                               [self.nodeCells[n] for n in goalNodes])
+        exits = dict((n, goalDist[0, i + 1]) for i, n in enumerate(goalNodes) if np.isfinite(goalDist[0, i + 1]))
+
+        # A* on the abstract graph, from the beginning (node -1) to the goal (node -2)
+        def heuristic(n):
+            x, y = self.nodeCells[n]
+            dx, dy = abs(x - goal.x), abs(y - goal.y)
+            return 1.4 * min(dx, dy) + abs(dx - dy)
+
+        g = {-1: 0.}
+        parents = {-1: None}
+        closed = set()
+        openList = [(0., -1)]
+
+        while openList:
+            f, current = heappop(openList)
+            if current in closed:
+                continue
+            if current == -2:
+                break
+            closed.add(current)
+            self.expanded += 1
+            if not self.expanded & 1023:
+                self.map.checkpoint(self.expanded)
+
+            if current == -1:
+                successors = [(n, beginDist[0, i + 1]) for i, n in enumerate(beginNodes)
+                              if np.isfinite(beginDist[0, i + 1])]
+            else:
+                successors = list(self.edges[current])
+                if current in exits:
+                    successors.append((-2, exits[current]))
+
+            for n, cost in successors:
+                gScore = g[current] + cost
+                if n not in closed and (n not in g or gScore < g[n]):
+                    g[n] = gScore
+                    parents[n] = current
+                    heappush(openList, (gScore + (heuristic(n) if n >= 0 else 0.), n))
+
+        if -2 not in parents:
+            return []
+
+        # Refining the abstract path into cells
+        abstractPath = [-2]
+        while abstractPath[-1] != -1:
+            abstractPath.append(parents[abstractPath[-1]])
+        abstractPath.reverse()
+
+        cells = []
+        for a, b in zip(abstractPath[:-1], abstractPath[1:]):
+            if a == -1:
+                cells += reversed(self.treePath(beginCluster, beginTree[0], self.nodeCells[b]))
+            elif b == -2:
+                if self.nodeCells[a] != (goal.x, goal.y):
+                    cells += self.treePath(goalCluster, goalTree[0], self.nodeCells[a])[1:] + [(goal.x, goal.y)]
+            elif self.cluster(*self.nodeCells[a]) != self.cluster(*self.nodeCells[b]):
+                # Going through an entrance
+                cells.append(self.nodeCells[b])
+            else:
+                cells += reversed(self.treePath(self.cluster(*self.nodeCells[a]), self.trees[a], self.nodeCells[b]))
+
+        return [Cell(x, y) for x, y in cells]
+
+
+class ThetaStar(AStar):
+    """
+    Lazy Theta* : an any-angle variant of A*. A cell's parent can be any cell in line of sight
+    (not only a neighbour), so paths are straight lines between a few waypoints. Line of sight is
+    only checked when a cell is expanded (hence 'lazy'), and not even then when the free radiuses of the
+    cell and its parent cover the segment between them. Only the waypoints are returned.
+    It trades time for shorter paths : about as many cells are expanded as with A*, plus the line of
+    sight checks, so it's slower than A* on cluttered maps (faster on open ones).
+    """
+
+    anyAngle = True
+
+    def update(self):
+        if self.version != self.map.version:
+            # Free radius (in cells) around each cell : all the cells closer than that are walkable
+            # (the distance to the closest unwalkable cell, the padding's included)
+            padded = np.zeros((self.map.height + 2, self.stride), dtype=bool)
+            padded[1:-1, 1:-1] = self.map.grid
+            self.freeRadius = scipy.ndimage.distance_transform_edt(padded).ravel().tolist()
+        super(ThetaStar, self).update()
+
+    def lineOfSight(self, a, b):
+        """ True if all the cells crossed by the segment between the centers of a and b are walkable """
+        walkable, s = self.walkable, self.stride
+        ay, ax = divmod(a, s)
+        by, bx = divmod(b, s)
+        stepX, stepY = cmp(bx, ax), cmp(by, ay)
+        dx, dy = abs(bx - ax), abs(by - ay)
+
+        # Walking through the cells, one axis at a time (diagonally when the line goes through a corner)
+        error = dx - dy
+        dx, dy = 2*dx, 2*dy
+        current = a
+        for i in xrange(dx/2 + dy/2):
+            if error > 0:
+                current += stepX
+                error -= dy
+            elif error < 0:
+                current += stepY*s
+                error += dx
+            else:
+                current += stepX + stepY*s
+                error += dx - dy
+            if not walkable[current]:
+                return False
+            if current == b:
+                return True
+
+        return True
+
+    def heuristic(self, index, goalX, goalY):
+        # Euclidean distance (the cost of an any-angle path)
+        y, x = divmod(index, self.stride)
+        return sqrt((x - goalX)**2 + (y - goalY)**2)
+
+    def search(self, begin, goal):
+        self.update()
+        self.generation += 1
+        self.expanded = 0
+
+        gen = self.generation
+        g, parent, opened, closed = self.g, self.parent, self.opened, self.closed
+        walkable, neighbours, heuristic, s = self.walkable, self.neighbours, self.heuristic, self.stride
+        lineOfSight, freeRadius = self.lineOfSight, self.freeRadius
+        steps = [(dy*s + dx, dx, dy) for dx, dy, cost in AStar.moves]
+
+        start, target = self.index(begin.x, begin.y), self.index(goal.x, goal.y)
+        goalY, goalX = divmod(target, s)
+
+        # The beginning is its own parent
+        g[start] = 0.
+        parent[start] = start
+        opened[start] = gen
+
+        h = heuristic(start, goalX, goalY)
+        openList = [(h, h, start)]
+
+        while openList:
+            f, h, current = heappop(openList)
+
+            if closed[current] == gen:
+                continue
+
+            # The parent was assumed to be in sight : if it isn't, the best expanded neighbour is used.
+            # The line stays within a cell of the segment : if the free radiuses of its ends cover it, it's clear
+            origin = parent[current]
+            originY, originX = divmod(origin, s)
+            currentY, currentX = divmod(current, s)
+            clear = freeRadius[origin] + freeRadius[current] - 2
+            if (clear <= 0 or (originX - currentX)**2 + (originY - currentY)**2 >= clear*clear) and \
+                    not lineOfSight(origin, current):
+                g[current] = float('inf')
+                for offset, cost in neighbours:
+                    neighbour = current + offset
+                    if closed[neighbour] == gen and g[neighbour] + cost < g[current]:
+                        g[current] = g[neighbour] + cost
+                        parent[current] = neighbour
+                origin = parent[current]
+                originY, originX = divmod(origin, s)
+
+            if current == target:
+                return self.path(start, target)
+
+            closed[current] = gen
+            self.expanded += 1
+            if not self.expanded & 1023:
+                self.map.checkpoint(self.expanded)
+
+            # Neighbours are linked to the current cell's parent (line of sight is checked later)
+            gOrigin = g[origin]
+            for offset, dx, dy in steps:
+                neighbour = current + offset
+                if not walkable[neighbour] or closed[neighbour] == gen:
+                    continue
+
+                x, y = currentX + dx, currentY + dy
+                gScore = gOrigin + sqrt((x - originX)**2 + (y - originY)**2)
+                if opened[neighbour] != gen or gScore < g[neighbour]:
+                    g[neighbour] = gScore
+                    parent[neighbour] = origin
+                    opened[neighbour] = gen
+                    h = sqrt((x - goalX)**2 + (y - goalY)**2)
+                    heappush(openList, (gScore + h, h, neighbour))
+
+        return []
+
+
+class DStarLite(AStar):
+    """
+    D* Lite : an incremental planner, searching from the goal to the beginning.
+    Its state is kept between queries to the same goal : when the beginning moves, or when cells of
+    the grid change reachability (a new obstacle, another radius, ...), only the affected part of
+    the solution is repaired instead of searching again from scratch.
+    """
+
+    def __init__(self, discreteMap):
+        super(DStarLite, self).__init__(discreteMap)
+
+        self.start = self.goal = None
+
+    def distance(self, a, b):
+        # Diagonal distance between two cells (the heuristic)
+        ay, ax = divmod(a, self.stride)
+        by, bx = divmod(b, self.stride)
+        dx, dy = abs(ax - bx), abs(ay - by)
+        return 1.4 * min(dx, dy) + abs(dx - dy)
+
+    def reset(self, start, goal):
+        inf = float('inf')
+        n = len(self.walkable)
+
+        # g : current estimate of the distance to the goal ; rhs : one-step lookahead of g
+        self.gs = array('d', [inf]) * n
+        self.rhs = array('d', [inf]) * n
+
+        # Priority queue (with lazy deletion : the valid key of each queued cell is in 'queued')
+        self.queue = []
+        self.queued = dict()
+
+        # Key modifier (accumulates the heuristic's changes when the beginning moves)
+        self.km = 0.
+        self.start = self.last = start
+        self.goal = goal
+
+        self.rhs[goal] = 0.
+        self.push(goal)
+
+    def key(self, u):
+        m = min(self.gs[u], self.rhs[u])
+        return (m + self.distance(self.start, u) + self.km, m)
+
+    def push(self, u):
+        k = self.key(u)
+        self.queued[u] = k
+        heappush(self.queue, (k, u))
+
+    def updateVertex(self, u):
+        gs, rhs, walkable = self.gs, self.rhs, self.walkable
+
+        if u != self.goal:
+            best = float('inf')
+            if walkable[u]:
+                for offset, cost in self.neighbours:
+                    v = u + offset
+                    if walkable[v] and cost + gs[v] < best:
+                        best = cost + gs[v]
+            rhs[u] = best
+
+        self.queued.pop(u, None)
+        if gs[u] != rhs[u]:
+            self.push(u)
+
+    def computeShortestPath(self):
+        gs, rhs, walkable, queue, queued = self.gs, self.rhs, self.walkable, self.queue, self.queued
+        start = self.start
+
+        while queue:
+            k, u = queue[0]
+            if queued.get(u) != k:
+                # Outdated entry
+                heappop(queue)
+                continue
+            if not (k < self.key(start) or rhs[start] != gs[start]):
+                break
+
+            # (Before popping : a cancelled search leaves the queue as it was)
+            if not (self.expanded + 1) & 1023:
+                self.map.checkpoint(self.expanded + 1)
+
+            heappop(queue)
+            newKey = self.key(u)
+            if k < newKey:
+                queued[u] = newKey
+                heappush(queue, (newKey, u))
+                continue
+
+            del queued[u]
+            self.expanded += 1
+
+            if gs[u] > rhs[u]:
+                gs[u] = rhs[u]
+            else:
+                gs[u] = float('inf')
+                self.updateVertex(u)
+
+            for offset, cost in self.neighbours:
+                v = u + offset
+                if walkable[v]:
+                    self.updateVertex(v)
+
+    def search(self, begin, goal):
+        start, target = self.index(begin.x, begin.y), self.index(goal.x, goal.y)
+        self.expanded = 0
+
+        if target != self.goal:
+            # Another goal : starting over
+            self.update()
+            self.reset(start, target)
+        else:
+            if start != self.start:
+                self.km += self.distance(self.last, start)
+                self.start = self.last = start
+
+            if self.version != self.map.version:
+                # Repairing around the cells that changed (the arrays themselves are rebuilt at once)
+                old = np.array(self.walkable, dtype=bool)
+                self.update()
+                changed = set()
+                for cell in np.flatnonzero(old != np.array(self.walkable, dtype=bool)):
+                    changed.add(cell)
+                    changed.update(cell + offset for offset, cost in self.neighbours)
+                try:
+                    for i, cell in enumerate(changed):
+                        if not (i + 1) & 1023:
+                            self.map.checkpoint(i + 1)
+                        self.updateVertex(cell)
+                except SearchCancelled:
+                    # Half repaired : the next search starts over
+                    self.goal = None
+                    raise
+
+        self.computeShortestPath()
+        return self.path(start, target)
+
+    def path(self, start, target):
+        # Following the steepest descent of g, from the beginning to the goal
+        gs, walkable = self.gs, self.walkable
+        if gs[start] == float('inf'):
+            return []
+
+        path = []
+        current = start
+        while current != target and len(path) < len(gs):
+            best, following = float('inf'), -1
+            for offset, cost in self.neighbours:
+                v = current + offset
+                if walkable[v] and cost + gs[v] < best:
+                    best, following = cost + gs[v], v
+            if following < 0:
+                return []
+
+            current = following
+            x, y = self.coordinates(current)
+            path.append(Cell(x, y))
+
+        return path
+
+
+class FlowField(object):
+    """
+    Distances from every cell of the grid to a goal, and the next cell to go to (a single Dijkstra
+    from the goal). The path from any cell is then found by following the field.
+    The Dijkstra (scipy's) can't be interrupted : the search can only be cancelled before and after it.
+    """
+
+    def __init__(self, discreteMap, goal):
+        self.goal = (goal.x, goal.y)
+        self.version = discreteMap.version
+        self.width, self.height = discreteMap.width, discreteMap.height
+
+        # The graph is undirected : the shortest path tree from the goal gives the next step to it
+        discreteMap.checkpoint(0)
+        graph = gridGraph(discreteMap.grid)
+        discreteMap.checkpoint(0)
+        dist, predecessors = scipy.sparse.csgraph.dijkstra(graph, indices=goal.y*self.width + goal.x,
+                                                           return_predecessors=True)
+        discreteMap.checkpoint(len(dist))
+
+        # Distance to the goal (inf if unreachable) and index of the next cell (-1 if none)
+        self.distances = dist.astype(np.float32).reshape(self.height, self.width)
+        self.next = np.where(predecessors < 0, -1, predecessors).astype(np.int32)
+
+    def distance(self, cell):
+        return float(self.distances[cell.y, cell.x])
+
+    def path(self, begin):
+        """ Cells from begin (excluded) to the goal, or an empty list if the goal can't be reached """
+        goal = self.goal[1]*self.width + self.goal[0]
+        current = begin.y*self.width + begin.x
+        if current == goal or self.next[current] < 0:
+            return []
+
+        path = []
+        while current != goal:
+            current = self.next[current]
+            y, x = divmod(int(current), self.width)
+            path.append(Cell(x, y))
+
+        return path
+
+    def memoryUsage(self):
+        """ Size of the field, in bytes """
+        return self.distances.nbytes + self.next.nbytes
+
+
+class FlowFieldSearch(object):
+    """ Search through the goal's flow field (worth it when many paths lead to the same goal) """
+
+    anyAngle = False
+
+    def __init__(self, discreteMap):
+        self.map = discreteMap
+        self.expanded = 0
+
+    def search(self, begin, goal):
+        cached = self.map.flowFieldsVersion == self.map.version and (goal.x, goal.y) in self.map.flowFields
+        field = self.map.flowField(goal)
+
+        # Building a field expands every cell
+        self.expanded = 0 if cached else len(field.next)
+        return field.path(begin)
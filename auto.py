@@ -12,13 +12,128 @@ from PySide.QtCore import *
 from widgets import NotificationTooltip, GraphicsCarItem, Waypoint, GraphicalParticleFilter
 
 from probability import ParticleFilter
+from astar import SearchCancelled
 from collections import deque
 from math import atan2, pi, radians, sqrt
 import random
+import time
 
 from geometry import simplifyPath
 
 
+class PathfindingThread(QThread):
+    """
+    Runs the searches away from the GUI's thread, one at a time. Only the latest request matters :
+    a new one cancels the search in progress (and replaces the one waiting, if any).
+    """
+
+    # (begin, goal, algorithm, path) once a search is over
+    found = Signal(object, object, object, object)
+    # Number of cells expanded so far, while searching
+    progress = Signal(int)
+    # (begin, goal) when a search took too long
+    timedOut = Signal(object, object)
+
+    # Maximal duration of a search (in seconds)
+    def_timeout = 10.
+
+    def __init__(self, parent=None, timeout=def_timeout):
+        super(PathfindingThread, self).__init__(parent)
+
+        self.timeout = timeout
+
+        self.mutex = QMutex()
+        self.condition = QWaitCondition()
+        # Held while a search runs (the map mustn't be changed meanwhile, see cancelAndWait)
+        self.searching = QMutex()
+
+        # The next search to run : (map, begin, goal, algorithm)
+        self.request = None
+        self.cancelled = False
+        self.running = True
+
+        self.started = 0.
+
+    def search(self, svgMap, begin, goal, algorithm):
+        self.mutex.lock()
+        self.request = (svgMap, begin, goal, algorithm)
+        self.cancelled = True
+        self.condition.wakeOne()
+        self.mutex.unlock()
+
+        if not self.isRunning():
+            self.start()
+
+    def cancel(self):
+        self.mutex.lock()
+        self.request = None
+        self.cancelled = True
+        self.mutex.unlock()
+
+    def cancelAndWait(self):
+        """Cancels the search in progress and waits for its end : the map can then be changed safely
+        (nothing else is searched until the next request)"""
+        self.cancel()
+        self.searching.lock()
+        self.searching.unlock()
+
+    def stop(self):
+        self.mutex.lock()
+        self.running = False
+        self.request = None
+        self.cancelled = True
+        self.condition.wakeOne()
+        self.mutex.unlock()
+
+        self.wait()
+
+    def monitor(self, expanded):
+        # Called by the search engine (in this thread) : False stops the search
+        self.mutex.lock()
+        cancelled, started = self.cancelled, self.started
+        self.mutex.unlock()
+
+        if cancelled or time.time() - started > self.timeout:
+            return False
+
+        self.progress.emit(expanded)
+        return True
+
+    def run(self):
+        while True:
+            self.mutex.lock()
+            while self.request is None and self.running:
+                self.condition.wait(self.mutex)
+
+            if not self.running:
+                self.mutex.unlock()
+                return
+
+            svgMap, begin, goal, algorithm = self.request
+            self.request = None
+            self.cancelled = False
+            self.started = time.time()
+            # (Taken before releasing the mutex : cancelAndWait can't miss this search)
+            self.searching.lock()
+            self.mutex.unlock()
+
+            svgMap.discreteMap.monitor = self.monitor
+            try:
+                path = svgMap.search(begin, goal, algorithm)
+            except SearchCancelled:
+                self.mutex.lock()
+                cancelled = self.cancelled
+                self.mutex.unlock()
+                if not cancelled:
+                    self.timedOut.emit(begin, goal)
+                continue
+            finally:
+                svgMap.discreteMap.monitor = None
+                self.searching.unlock()
+
+            self.found.emit(begin, goal, algorithm, path)
+
+
 class AutoScene(QGraphicsScene):
 
     def __init__(self, car, parent=None):
@@ -53,6 +168,16 @@ class AutoScene(QGraphicsScene):
         self.Ynotif = 20
         self.notifications = list()
 
+        # Searches are run in the background (the goal of the last one requested is kept)
+        self.pathfinder = PathfindingThread(self)
+        self.pathfinder.found.connect(self.pathFound)
+        self.pathfinder.progress.connect(self.pathProgress)
+        self.pathfinder.timedOut.connect(self.pathTimedOut)
+        self.pendingGoal = None
+        self.searchNotified = False
+
+        QCoreApplication.instance().aboutToQuit.connect(self.pathfinder.stop)
+
     def clearNotification(self):
         self.notifications.pop(-1)
         if len(self.notifications) == 0:
@@ -77,114 +202,146 @@ class AutoScene(QGraphicsScene):
         elif not self.map.isReachable(self.car.x, self.car.y):
             self.notify("Can't move the car from its current position.", type=NotificationTooltip.error)
         else:
-            # We generate a path from the car to where we clicked and show it on the UI
-            # We get the path from our 'map' object
-            self.path = self.map.search((self.car.x, self.car.y), (x, y))
-
-            if len(self.path) == 0:
-                return
-
-            # And a simple version of the path (to be sent to the car)
+            # We generate a path from the car to where we clicked (in the background, see pathFound)
+            self.pendingGoal = (x, y)
+            self.searchNotified = False
+            self.pathfinder.search(self.map, (self.car.x, self.car.y), (x, y), self.map.discreteMap.algorithm)
+
+    def stopSearch(self):
+        """To be called before changing the map (scale, orientation, car's size) : the search in
+        progress is cancelled, and the result of a finished one ignored"""
+        self.pathfinder.cancelAndWait()
+        self.pendingGoal = None
+
+    def pathProgress(self, expanded):
+        if not self.searchNotified:
+            # Only long searches report their progress
+            self.notify("Searching a path...", type=NotificationTooltip.information)
+            self.searchNotified = True
+
+    def pathTimedOut(self, begin, goal):
+        if goal == self.pendingGoal:
+            self.pendingGoal = None
+            self.notify("No path found in {:.0f}s.".format(self.pathfinder.timeout), type=NotificationTooltip.error)
+
+    def pathFound(self, begin, goal, algorithm, path):
+        # Results of searches replaced by a newer one are ignored
+        if goal != self.pendingGoal:
+            return
+        self.pendingGoal = None
+
+        self.path = path
+        print "[ * ] {}".format(self.map.pathCache)
+
+        if len(self.path) == 0:
+            self.notify("No path leads there.", type=NotificationTooltip.error)
+            return
+
+        # And a simple version of the path (to be sent to the car)
+        if self.map.discreteMap.isAnyAngle(algorithm):
+            # Already made of waypoints only
+            self.sPath = list(self.path)
+        else:
             self.sPath = simplifyPath(self.path)
 
-            # If the car is currently on a path, we end it
-            self.pathFinished()
+        # If the car is currently on a path, we end it
+        self.pathFinished()
 
-            # We build a polyline graphic item
-            painterPath = QPainterPath()
-            totalPath = QPainterPath()
+        # We build a polyline graphic item
+        painterPath = QPainterPath()
+        totalPath = QPainterPath()
 
-            self.waypoints = list()
+        self.waypoints = list()
 
-            painterPath.moveTo(self.sPath[0].x, self.sPath[0].y)
-            totalPath.moveTo(self.path[0].x, self.path[0].y)
+        painterPath.moveTo(self.sPath[0].x, self.sPath[0].y)
+        totalPath.moveTo(self.path[0].x, self.path[0].y)
 
-            waypoint = Waypoint(self.path[0].x, self.path[0].y)
-            self.addItem(waypoint)
-            self.waypoints.append(waypoint)
+        waypoint = Waypoint(self.path[0].x, self.path[0].y)
+        self.addItem(waypoint)
+        self.waypoints.append(waypoint)
 
-            # We draw a line (and waypoints) of the simplified path
-            for i in xrange(1, len(self.sPath)):
-                x, y = self.sPath[i].x, self.sPath[i].y
+        # We draw a line (and waypoints) of the simplified path
+        for i in xrange(1, len(self.sPath)):
+            x, y = self.sPath[i].x, self.sPath[i].y
 
-                painterPath.lineTo(x, y)
+            painterPath.lineTo(x, y)
 
-                waypoint = Waypoint(x, y)
-                self.addItem(waypoint)
-                self.waypoints.append(waypoint)
+            waypoint = Waypoint(x, y)
+            self.addItem(waypoint)
+            self.waypoints.append(waypoint)
 
-            # We draw a path (mainly just for the total distance) of the original path
-            for i in xrange(1, len(self.path)):
-                x, y = self.path[i].x, self.path[i].y
-                totalPath.lineTo(x, y)
+        # We draw a path (mainly just for the total distance) of the original path
+        for i in xrange(1, len(self.path)):
+            x, y = self.path[i].x, self.path[i].y
+            totalPath.lineTo(x, y)
 
-            # We update the path shown on screen
-            self.graphicalPath.setPath(painterPath)
+        # We update the path shown on screen
+        self.graphicalPath.setPath(painterPath)
 
-            # Animating the car on the path
-            self.animation = QParallelAnimationGroup()
+        # Animating the car on the path
+        self.animation = QParallelAnimationGroup()
 
-            posAnim = QPropertyAnimation(self.car, "positionProperty")
-            rotAnim = QPropertyAnimation(self.car, "angleProperty")
+        posAnim = QPropertyAnimation(self.car, "positionProperty")
+        rotAnim = QPropertyAnimation(self.car, "angleProperty")
 
-            # Calculating the animation's duration
-            totalLength = totalPath.length()
-            pixelsPerMS = 200. / 1000.
-            totalDuration = totalLength / pixelsPerMS
+        # Calculating the animation's duration
+        totalLength = totalPath.length()
+        pixelsPerMS = 200. / 1000.
+        totalDuration = totalLength / pixelsPerMS
 
-            posAnim.setDuration(totalDuration)
-            rotAnim.setDuration(totalDuration)
+        posAnim.setDuration(totalDuration)
+        rotAnim.setDuration(totalDuration)
 
-            posAnim.setKeyValueAt(0, QPointF(self.car.x, self.car.y))
-            rotAnim.setKeyValueAt(0, self.car.angle)
+        posAnim.setKeyValueAt(0, QPointF(self.car.x, self.car.y))
+        rotAnim.setKeyValueAt(0, self.car.angle)
 
-            angles = deque()
-            angles.append(self.car.angle)
-            curAngle = self.car.angle
+        angles = deque()
+        angles.append(self.car.angle)
+        curAngle = self.car.angle
 
-            t = 0.
+        t = 0.
 
-            for i in xrange(1, len(self.path) - 1):
-                #This loop describes going from path[i-1] to path[i]
+        for i in xrange(1, len(self.path) - 1):
+            #This loop describes going from path[i-1] to path[i]
 
-                pt = self.path[i]
-                lastPt = self.path[i-1]
+            pt = self.path[i]
+            lastPt = self.path[i-1]
 
-                distance = sqrt( (pt.x - lastPt.x)**2 + (pt.y - lastPt.y)**2 )
+            distance = sqrt( (pt.x - lastPt.x)**2 + (pt.y - lastPt.y)**2 )
 
-                # Time's evolution (distance / speed)
-                t += distance/pixelsPerMS
+            # Time's evolution (distance / speed)
+            t += distance/pixelsPerMS
 
-                posAnim.setKeyValueAt(t/totalDuration, QPointF(pt.x, pt.y))
+            posAnim.setKeyValueAt(t/totalDuration, QPointF(pt.x, pt.y))
 
-                # Calculation of the 'new' angle
-                newAngle = pi/2 + radians(self.car.map.north_angle) - atan2(lastPt.y - pt.y, lastPt.x - pt.x)
+            # Calculation of the 'new' angle
+            newAngle = pi/2 + radians(self.car.map.north_angle) - atan2(lastPt.y - pt.y, lastPt.x - pt.x)
 
-                if abs(2*pi + newAngle - curAngle) < abs(newAngle - curAngle):
-                    curAngle = 2*pi + newAngle
-                else:
-                    curAngle = newAngle
+            if abs(2*pi + newAngle - curAngle) < abs(newAngle - curAngle):
+                curAngle = 2*pi + newAngle
+            else:
+                curAngle = newAngle
 
-                angles.append( curAngle )
-                rotAnim.setKeyValueAt(t/totalDuration, sum(angles)/len(angles))
+            angles.append( curAngle )
+            rotAnim.setKeyValueAt(t/totalDuration, sum(angles)/len(angles))
 
-                if len(angles) > 10:
-                    angles.popleft()
+            if len(angles) > 10:
+                angles.popleft()
 
 
-            posAnim.setEndValue(QPointF(self.path[-1].x, self.path[-1].y))
-            rotAnim.setEndValue(angles[-1])
+        posAnim.setEndValue(QPointF(self.path[-1].x, self.path[-1].y))
+        rotAnim.setEndValue(angles[-1])
 
-            posAnim.setEasingCurve(QEasingCurve.InOutQuad)
-            rotAnim.setEasingCurve(QEasingCurve.InOutQuad)
+        posAnim.setEasingCurve(QEasingCurve.InOutQuad)
+        rotAnim.setEasingCurve(QEasingCurve.InOutQuad)
 
-            self.animation.addAnimation(rotAnim)
-            self.animation.addAnimation(posAnim)
+        self.animation.addAnimation(rotAnim)
+        self.animation.addAnimation(posAnim)
 
-            self.animation.finished.connect(self.pathFinished)
+        self.animation.finished.connect(self.pathFinished)
 
-            self.animation.start(QAbstractAnimation.DeleteWhenStopped)
-            self.car.setMoving(True)
+        self.animation.start(QAbstractAnimation.DeleteWhenStopped)
+        self.car.setMoving(True)
 
     def pathFinished(self):
     # Called when the car has arrived to the path's end
@@ -251,14 +408,15 @@ class AutoScene(QGraphicsScene):
                     noisyCarAngle = self.car.angle + random.gauss(0.0, radians(self.car.rotation_noise))
                     self.particleFilter.setAngle(noisyCarAngle)
                     self.particleFilter.move(speed)
-                    self.particleFilter.sense(self.car.distance, noisyCarAngle)
+                    # A sweep of the sensor (rather than the single distance ahead)
+                    self.particleFilter.senseScan(self.car.scan(), noisyCarAngle)
                     self.particleFilter.resample()
                     self.heatmap.update()
 
                     relevance = self.particleFilter.relevance
                     if relevance >= ParticleFilter.DecentRelevance and not self.car.localized:
-                        self.notify("Car localized with a {}% relevance rate".format(int(100*relevance)),
-                                    type=NotificationTooltip.ok)
+                        self.notify("Car localized with a {}% relevance rate ({} particles)".format(
+                                    int(100*relevance), self.particleFilter.N), type=NotificationTooltip.ok)
                         self.car.localized = True
                     elif self.car.localized and relevance < ParticleFilter.DecentRelevance - 0.10:
                         self.notify("Lost car's localization !")
@@ -271,6 +429,7 @@ class AutoScene(QGraphicsScene):
                 # self.car.setPosition(QPointF(x, y))
 
     def setMapScale(self):
+        self.stopSearch()
         ok = False
         while not ok:
             # We ask for the scale in 'mm per px' as it's easier to imagine, but convert it to px per mm
@@ -281,6 +440,7 @@ class AutoScene(QGraphicsScene):
         self.map.setScale(1. / mm_per_px)
 
     def setMapNorthAngle(self):
+        self.stopSearch()
         ok = False
         while not ok:
             curValue = self.map.north_angle if self.map.north_angle is not None else 0.
@@ -326,6 +486,10 @@ class AutoView(QGraphicsView):
         s.path = None
         s.graphicalPath = None
 
+        # A search on the previous map is useless now
+        s.pathfinder.cancel()
+        s.pendingGoal = None
+
         # We remove the current view from the car's model
         s.car.removeView(s.graphicCar)
 
@@ -407,7 +571,7 @@ class AutoView(QGraphicsView):
 
         # Heatmap
         if s.particleFilter is None:
-            s.particleFilter = ParticleFilter(car=s.car, map=s.map)
+            s.particleFilter = ParticleFilter(car=s.car, map=s.map, adaptive=True, tracking=True)
         else:
             s.particleFilter.reset()
             s.particleFilter.setMap(s.map)
@@ -0,0 +1,211 @@
+# -*- coding: utf8 -*-
+
+"""
+    benchmark.py - headless pathfinding benchmark, over the bundled maps and generated ones.
+    The results are written as JSON, to compare runs before and after a change. Each map, and each algorithm
+    on it, is run in its own (forked) process : their memory growths don't mix.
+
+    Usage : python benchmark.py [-o results.json] [--queries 50] [--seed 0] [--algorithms astar jps ...]
+"""
+
+import os
+import glob
+import json
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import resource
+import traceback
+import multiprocessing
+import numpy as np
+from math import sqrt
+
+from svg import SvgTree, PathCache
+from astar import DiscreteMap, Cell
+
+algorithms = {'astar': DiscreteMap.astar, 'jps': DiscreteMap.jps, 'hpa': DiscreteMap.hpa,
+              'thetastar': DiscreteMap.thetastar, 'dstarlite': DiscreteMap.dstarlite,
+              'flowfield': DiscreteMap.flowfield}
+
+# Generated maps : (width, height, number of obstacles)
+def_sizes = [(800, 600, 60), (1600, 1200, 250), (3200, 2400, 1000)]
+
+
+def syntheticMap(path, width, height, obstacles, seed=0):
+    """ Writes a map of random rectangles (a few of them being long walls) """
+    rand = random.Random(seed)
+    svgFile = open(path, 'w')
+    svgFile.write('<svg xmlns="http://www.w3.org/2000/svg" xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd" '
+                  'width="{}px" height="{}px" pixel_per_mm="1.0" north_angle="0.0">\n'.format(width, height))
+
+    for i in xrange(obstacles):
+        if rand.random() < 0.2:
+            # Walls
+            w, h = rand.uniform(100, 400), rand.uniform(5, 15)
+            if rand.random() < 0.5:
+                w, h = h, w
+        else:
+            w, h = rand.uniform(10, 80), rand.uniform(10, 80)
+        x, y = rand.uniform(0, width - w), rand.uniform(0, height - h)
+        svgFile.write('<rect x="{:.1f}" y="{:.1f}" width="{:.1f}" height="{:.1f}"/>\n'.format(x, y, w, h))
+
+    svgFile.write('</svg>\n')
+    svgFile.close()
+
+
+def peakMemory():
+    """ Peak resident memory of the process (in kB) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def isolated(function, *args):
+    """ Runs function(*args) in a forked process. Returns its result and how much the process' peak memory
+    grew meanwhile (in kB : a forked process' peak starts at its current memory, not at its parent's peak) """
+    queue = multiprocessing.Queue()
+
+    def run():
+        start = peakMemory()
+        try:
+            result = function(*args)
+            queue.put((result, peakMemory() - start, None))
+        except Exception:
+            queue.put((None, 0, traceback.format_exc()))
+
+    process = multiprocessing.Process(target=run)
+    process.start()
+    result, growth, error = queue.get()
+    process.join()
+
+    if error is not None:
+        raise RuntimeError("Benchmark run failed :\n" + error)
+    return result, growth
+
+
+def pathLength(begin, path):
+    """ Length of a path (in its cells' or points' unit), its beginning included """
+    length = 0.
+    previous = begin
+    for cell in path:
+        length += sqrt((cell.x - previous.x)**2 + (cell.y - previous.y)**2)
+        previous = cell
+
+    return length
+
+
+def statistics(values):
+    if not values:
+        return None
+    return {'mean': float(np.mean(values)), 'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)), 'p99': float(np.percentile(values, 99)),
+            'max': float(np.max(values))}
+
+
+def queries(discreteMap, count, seed):
+    """ Pairs of reachable cells (the same ones for a given map and seed) """
+    reachable = np.flatnonzero(discreteMap.grid)
+    if len(reachable) == 0:
+        return []
+
+    rand = random.Random(seed)
+    pairs = []
+    for i in xrange(count):
+        b, g = divmod(reachable[rand.randrange(len(reachable))], discreteMap.width), \
+               divmod(reachable[rand.randrange(len(reachable))], discreteMap.width)
+        pairs.append((Cell(b[1], b[0]), Cell(g[1], g[0])))
+
+    return pairs
+
+
+def benchmarkAlgorithm(svgMap, pairs, name):
+    """ The queries go through the map's path cache, as in the application : the engine's statistics are the
+    misses' ones. Each query is then repeated (hitting the cache), to compare the hits' latency with the misses' """
+    discreteMap = svgMap.discreteMap
+    engine = discreteMap.engines[algorithms[name]]
+    div = discreteMap.division
+    latencies, expanded, lengths, hitLatencies = [], [], [], []
+    svgMap.pathCache = PathCache()
+
+    for begin, goal in pairs:
+        # (The cells' centers, in pixels)
+        b, g = ((begin.x + 0.5) * div, (begin.y + 0.5) * div), ((goal.x + 0.5) * div, (goal.y + 0.5) * div)
+
+        misses = svgMap.pathCache.misses
+        t = time.time()
+        path = svgMap.search(b, g, algorithms[name])
+        if svgMap.pathCache.misses > misses:
+            latencies.append(1000 * (time.time() - t))
+            expanded.append(engine.expanded)
+            if path:
+                lengths.append(pathLength(Cell(begin.x * div, begin.y * div), path))
+
+        t = time.time()
+        svgMap.search(b, g, algorithms[name])
+        hitLatencies.append(1000 * (time.time() - t))
+
+    cache = {'hits': svgMap.pathCache.hits, 'misses': svgMap.pathCache.misses, 'latency': statistics(hitLatencies)}
+    return {'latency': statistics(latencies), 'expanded': statistics(expanded),
+            'pathLength': statistics(lengths), 'found': len(lengths), 'cache': cache}
+
+
+def benchmark(path, names, count, seed, radius):
+    t = time.time()
+    svgMap = SvgTree(path, radius)
+    discreteMap = svgMap.discreteMap
+    result = {'map': os.path.basename(path), 'width': svgMap.width, 'height': svgMap.height,
+              'cells': discreteMap.width * discreteMap.height, 'loadTime': time.time() - t,
+              'algorithms': {}}
+
+    pairs = queries(discreteMap, count, seed)
+    for name in names:
+        # (Each algorithm starts from the loaded map only)
+        stats, growth = isolated(benchmarkAlgorithm, svgMap, pairs, name)
+        stats['memoryGrowth'] = growth
+        result['algorithms'][name] = stats
+        print "[ * ] {} - {} : p50 {:.1f} ms, p99 {:.1f} ms, +{} kB, cached p50 {:.3f} ms".format(
+            result['map'], name, stats['latency']['p50'] if pairs else 0, stats['latency']['p99'] if pairs else 0,
+            growth, stats['cache']['latency']['p50'] if pairs else 0)
+
+    return result
+
+
+def benchmarkMap(path, names, count, seed, radius):
+    """ The map's results, with the memory its loading took """
+    result, growth = isolated(benchmark, path, names, count, seed, radius)
+    result['memoryGrowth'] = growth
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pathfinding benchmark")
+    parser.add_argument('-o', '--output', help="JSON file to write (printed if not given)")
+    parser.add_argument('--maps', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'maps', '*.svg'),
+                        help="Pattern of the svg maps to load")
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--radius', type=int, default=20, help="Car's size (in pixels)")
+    parser.add_argument('--algorithms', nargs='+', choices=sorted(algorithms), default=['astar', 'jps', 'hpa', 'thetastar'])
+    parser.add_argument('--no-synthetic', dest='synthetic', action='store_false', help="Only the svg maps")
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(args.maps))
+
+    directory = tempfile.mkdtemp()
+    try:
+        if args.synthetic:
+            for width, height, obstacles in def_sizes:
+                path = os.path.join(directory, 'synthetic-{}x{}.svg'.format(width, height))
+                syntheticMap(path, width, height, obstacles, args.seed)
+                paths.append(path)
+
+        results = {'seed': args.seed, 'queries': args.queries, 'radius': args.radius, 'time': time.time(),
+                   'maps': [benchmarkMap(path, args.algorithms, args.queries, args.seed, args.radius) for path in paths]}
+    finally:
+        shutil.rmtree(directory)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
@@ -7,6 +7,7 @@
 
 from PySide.QtCore import *
 from math import cos, sin, pi, radians
+import numpy as np
 
 
 class Car(QObject):
@@ -30,6 +31,9 @@ class Car(QObject):
     # Distance at which the car is 'in danger' (obstacle too close)
     danger_distance = 150
 
+    # Servo angles (in degrees) of a sweep of the sensor
+    def_sweep = range(-45, 46, 15)
+
     def __init__(self, map=None, carSocket=None, x=0, y=0, width=def_width, length=def_length):
         super(Car, self).__init__()
 
@@ -160,6 +164,15 @@ class Car(QObject):
             self.socket.setMaxSpeed(self.maxspeed)
 
 
+    def scan(self, servoAngles=def_sweep):
+        """ Simulated sweep of the sensor : (servo angle, distance) pairs, distances in mm (None if there's
+        no obstacle). Servo angles are in degrees, positive to the left. """
+        angles = self.angle + np.radians(servoAngles)
+        distances = self.map.rayDistances(self.x, self.y, angles)
+
+        return [(servoAngle, float(distance) if np.isfinite(distance) else None)
+                for servoAngle, distance in zip(servoAngles, distances)]
+
     def notify(self, signal=1):
         self.updateSignal.emit(signal)
 
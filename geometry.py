@@ -31,6 +31,73 @@ def simplifyPath(path, angleEpsilon = 0.3, minDist = 80):
         # Can't simplify a path of 2 nodes or less
         return path
 
+def segmentsHits(x, y, dx, dy, segments):
+    """ Distances along rays (origin (x, y), unit vector (dx, dy)) to segments [..., x1, y1, x2, y2]
+    Arrays are broadcast together. inf where a ray doesn't cross the segment. """
+    # o + t*v = a + u*(b - a)  <=>  t = (w x e) / (v x e) ; u = (w x v) / (v x e)
+    # with w = a - o and e = b - a
+    ex = segments[..., 2] - segments[..., 0]
+    ey = segments[..., 3] - segments[..., 1]
+    wx = segments[..., 0] - x
+    wy = segments[..., 1] - y
+
+    denom = dx*ey - dy*ex
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (wx*ey - wy*ex) / denom
+        u = (wx*dy - wy*dx) / denom
+
+        t[(denom == 0) | (t < 0) | (u < 0) | (u > 1)] = np.inf
+    return t
+
+def ellipsesHits(x, y, dx, dy, ellipses):
+    """ Distances along rays to ellipses [..., cx, cy, rx, ry] (same conventions as segmentsHits) """
+    # ((x + t*dx - cx) / rx)^2 + ((y + t*dy - cy) / ry)^2 = 1  <=>  a*t^2 + b*t + c = 0
+    cx, cy, rx, ry = ellipses[..., 0], ellipses[..., 1], ellipses[..., 2], ellipses[..., 3]
+    px, py = (x - cx) / rx, (y - cy) / ry
+    qx, qy = dx / rx, dy / ry
+
+    a = qx**2 + qy**2
+    b = 2*(px*qx + py*qy)
+    c = px**2 + py**2 - 1
+    delta = b**2 - 4*a*c
+
+    with np.errstate(invalid='ignore'):
+        root = np.sqrt(delta)
+        t1 = (-b - root) / (2*a)
+        t2 = (-b + root) / (2*a)
+
+        # The closest intersection that is in front of the ray
+        t = np.where(t1 >= 0, t1, np.where(t2 >= 0, t2, np.inf))
+        t[~(delta >= 0)] = np.inf
+    return t
+
+def castRays(ox, oy, vx, vy, segments, ellipses, chunk=4096):
+    """ Casts many rays at once against arrays of segments and ellipses.
+
+    ox, oy : rays' origins ; vx, vy : rays' (unit) direction vectors
+    segments : (M, 4) array of [x1, y1, x2, y2]
+    ellipses : (K, 4) array of [cx, cy, rx, ry]
+
+    Returns an array with the distance from each origin to the closest
+    intersection (inf if a ray doesn't hit anything).
+    Rays are processed by chunks to keep the (rays x shapes) matrices small.
+    """
+    n = len(ox)
+    dist = np.empty(n)
+    dist.fill(np.inf)
+
+    for start in xrange(0, n, chunk):
+        s = slice(start, start + chunk)
+        x, y = ox[s, None], oy[s, None]
+        dx, dy = vx[s, None], vy[s, None]
+
+        if len(segments) > 0:
+            dist[s] = np.minimum(dist[s], segmentsHits(x, y, dx, dy, segments).min(axis=1))
+        if len(ellipses) > 0:
+            dist[s] = np.minimum(dist[s], ellipsesHits(x, y, dx, dy, ellipses).min(axis=1))
+
+    return dist
+
 def lineMagnitude(p1, p2):
     return sqrt((p2.x - p1.x)**2 + (p2.y - p1.y)**2)
 
@@ -109,6 +176,8 @@ class Point:
             return onX and onY
         elif isinstance(shape, Ellipse):
             return ((self.x - shape.center.x) / shape.rx)**2 + ((self.y - shape.center.y) / shape.ry)**2 <= 1
+        elif isinstance(shape, Polygone):
+            return bool(shape.containsPoints(self.x, self.y))
 
     def __str__(self):
         return "Point [{}, {}]".format(self.x, self.y)
@@ -128,6 +197,14 @@ class Shape(object):
     def contains(self, shape):
         self.boundingRect.contains(shape.boundingRect)
 
+    def edges(self):
+        """ The shape's border as a list of [x1, y1, x2, y2] segments """
+        return []
+
+    def containsPoints(self, xs, ys):
+        """ Vectorized containment test (xs and ys are broadcast together) """
+        return np.zeros(np.broadcast(xs, ys).shape, dtype=bool)
+
 
 # TODO : Finish this
 class Polyline(Shape):
@@ -136,6 +213,7 @@ class Polyline(Shape):
         super(Polyline, self).__init__()
 
         self.points = points
+        self.closed = closed
         self.segments = []
 
         xmin, ymin = float('inf'), float('inf')
@@ -151,7 +229,16 @@ class Polyline(Shape):
                 self.segments.append(Segment(points[i].x, points[i].y, points[
                                      (i+1) % len(points)].x, points[(i+1) % len(points)].y))
 
-        self.boundingRect = Rectangle(xmin, xmax, xmax-xmin, ymax-ymin)
+        self.boundingRect = Rectangle(xmin, ymin, xmax-xmin, ymax-ymin)
+
+    def edges(self):
+        result = []
+        n = len(self.points)
+        for i in range(n):
+            if (i != n-1) or (self.closed and n > 2):
+                p1, p2 = self.points[i], self.points[(i+1) % n]
+                result.append([p1.x, p1.y, p2.x, p2.y])
+        return result
 
     def __str__(self):
         result = "Polyline #{} : ".format(self.id)
@@ -167,6 +254,18 @@ class Polygone(Shape):
         self.border = Polyline(points)
         self.boundingRect = self.border.boundingRect
 
+    def edges(self):
+        return self.border.edges()
+
+    def containsPoints(self, xs, ys):
+        # Even-odd rule : counting the edges crossed by an horizontal ray going right
+        inside = np.zeros(np.broadcast(xs, ys).shape, dtype=bool)
+        for x1, y1, x2, y2 in self.edges():
+            if y1 != y2:
+                crosses = ((y1 > ys) != (y2 > ys)) & (xs < (x2 - x1) * (ys - y1) / float(y2 - y1) + x1)
+                inside ^= crosses
+        return inside
+
     def __str__(self):
         result = "Polygone #{} : ".format(self.id)
         for point in self.points:
@@ -190,6 +289,15 @@ class Rectangle(Shape):
 
         return result
 
+    def edges(self):
+        x, y = self.origin.x, self.origin.y
+        w, h = self.width, self.height
+        return [[x, y, x+w, y], [x+w, y, x+w, y+h], [x+w, y+h, x, y+h], [x, y+h, x, y]]
+
+    def containsPoints(self, xs, ys):
+        x, y = self.origin.x, self.origin.y
+        return (xs >= x) & (xs <= x + self.width) & (ys >= y) & (ys <= y + self.height)
+
     def __str__(self):
         return "Rectangle #{} at {} with {} width and {} height".format(self.id, self.origin, self.width, self.height)
 
@@ -202,6 +310,9 @@ class Ellipse(Shape):
         self.rx, self.ry = rx, ry
         self.boundingRect = Rectangle(cx-rx, cy-ry, 2*rx, 2*ry)
 
+    def containsPoints(self, xs, ys):
+        return ((xs - self.center.x) / self.rx)**2 + ((ys - self.center.y) / self.ry)**2 <= 1
+
     def __str__(self):
         return "Ellipse #{} : Center = {} ; rx = {} ; ry = {}".format(self.id, self.center, self.rx, self.ry)
 
@@ -394,6 +505,170 @@ class Segment(Ray):
     def __str__(self):
         return "Segment [ {}, {} ]".format(self.origin, self.origin.translated(self.vector*self.length))
 
+class ShapeGrid(object):
+    """
+    A uniform grid over the shapes' bounding rectangles (a spatial index).
+    Each cell knows the shapes, segments and ellipses overlapping it, so that containment tests
+    only check the shapes around a point, and rays only test what's in the cells they cross.
+    """
+
+    # Number of cells along the map's longest side
+    def_cells = 32
+
+    def __init__(self, shapes, segments, ellipses, cells=def_cells):
+        self.shapes = shapes
+        self.segments = segments
+        self.ellipses = ellipses
+
+        # Bounds of the indexed area (covering all segments and ellipses)
+        xmins = np.concatenate([segments[:, [0, 2]].min(axis=1), ellipses[:, 0] - ellipses[:, 2]])
+        ymins = np.concatenate([segments[:, [1, 3]].min(axis=1), ellipses[:, 1] - ellipses[:, 3]])
+        xmaxs = np.concatenate([segments[:, [0, 2]].max(axis=1), ellipses[:, 0] + ellipses[:, 2]])
+        ymaxs = np.concatenate([segments[:, [1, 3]].max(axis=1), ellipses[:, 1] + ellipses[:, 3]])
+
+        self.x0, self.y0 = xmins.min(), ymins.min()
+        self.cellSize = max(xmaxs.max() - self.x0, ymaxs.max() - self.y0, 1.) / cells
+        self.nx = int((xmaxs.max() - self.x0) / self.cellSize) + 1
+        self.ny = int((ymaxs.max() - self.y0) / self.cellSize) + 1
+
+        # Shapes (for containment tests) in each cell
+        self.cellShapes = [[] for i in xrange(self.nx * self.ny)]
+        for shape in shapes:
+            rect = shape.boundingRect
+            for cell in self.cellsIn(rect.origin.x, rect.origin.y, rect.origin.x + rect.width, rect.origin.y + rect.height):
+                self.cellShapes[cell].append(shape)
+
+        # Segments and ellipses in each cell, as (cells x max. number per cell) arrays padded with -1
+        n = len(segments)
+        self.cellSegments = self.padded([self.cellsIn(xmins[i], ymins[i], xmaxs[i], ymaxs[i]) for i in xrange(n)])
+        self.cellEllipses = self.padded([self.cellsIn(xmins[n+i], ymins[n+i], xmaxs[n+i], ymaxs[n+i])
+                                         for i in xrange(len(ellipses))])
+
+    def cellsIn(self, xmin, ymin, xmax, ymax):
+        """ Indexes of the cells overlapping a rectangle (touching its border included) """
+        eps = 1e-6
+        i0 = max(0, int(np.floor((xmin - self.x0) / self.cellSize - eps)))
+        i1 = min(self.nx - 1, int(np.floor((xmax - self.x0) / self.cellSize + eps)))
+        j0 = max(0, int(np.floor((ymin - self.y0) / self.cellSize - eps)))
+        j1 = min(self.ny - 1, int(np.floor((ymax - self.y0) / self.cellSize + eps)))
+
+        return [j*self.nx + i for j in xrange(j0, j1 + 1) for i in xrange(i0, i1 + 1)]
+
+    def padded(self, cellsPerItem):
+        perCell = [[] for i in xrange(self.nx * self.ny)]
+        for item, cells in enumerate(cellsPerItem):
+            for cell in cells:
+                perCell[cell].append(item)
+
+        result = -np.ones((len(perCell), max([1] + [len(items) for items in perCell])), dtype=int)
+        for cell, items in enumerate(perCell):
+            result[cell, :len(items)] = items
+        return result
+
+    def shapesAt(self, x, y):
+        """ The shapes that may contain (x, y) """
+        i = int(np.floor((x - self.x0) / self.cellSize))
+        j = int(np.floor((y - self.y0) / self.cellSize))
+        if 0 <= i < self.nx and 0 <= j < self.ny:
+            return self.cellShapes[j*self.nx + i]
+        else:
+            return []
+
+    def containsPoints(self, xs, ys):
+        """ Vectorized containment test : True for the points inside any of the shapes
+        (points are grouped by cell, and only tested against the shapes of their cell) """
+        xs, ys = np.broadcast_arrays(np.asarray(xs, dtype=float), np.asarray(ys, dtype=float))
+        dimensions = xs.shape
+        xs, ys = xs.ravel(), ys.ravel()
+        inside = np.zeros(len(xs), dtype=bool)
+
+        i = np.floor((xs - self.x0) / self.cellSize).astype(int)
+        j = np.floor((ys - self.y0) / self.cellSize).astype(int)
+        cells = np.where((i >= 0) & (i < self.nx) & (j >= 0) & (j < self.ny), j*self.nx + i, -1)
+
+        order = np.argsort(cells, kind='mergesort')
+        sortedCells = cells[order]
+        bounds = np.flatnonzero(np.diff(sortedCells)) + 1
+        for start, end in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(cells)]])):
+            cell = sortedCells[start]
+            if cell < 0 or not self.cellShapes[cell]:
+                continue
+
+            points = order[start:end]
+            px, py = xs[points], ys[points]
+            hits = np.zeros(len(points), dtype=bool)
+            for shape in self.cellShapes[cell]:
+                hits |= shape.containsPoints(px, py)
+            inside[points] = hits
+
+        return inside.reshape(dimensions)
+
+    def castRays(self, ox, oy, vx, vy, chunk=16384):
+        """ Same as castRays, but each ray walks through the grid's cells (front-to-back)
+        and stops at the first cell in which it has a confirmed hit. """
+        n = len(ox)
+        dist = np.empty(n)
+        dist.fill(np.inf)
+
+        # Rays starting outside the grid are tested against all the shapes
+        gx, gy = (ox - self.x0) / self.cellSize, (oy - self.y0) / self.cellSize
+        outside = (gx < 0) | (gx > self.nx) | (gy < 0) | (gy > self.ny)
+        if outside.any():
+            dist[outside] = castRays(ox[outside], oy[outside], vx[outside], vy[outside], self.segments, self.ellipses)
+
+        inside = np.flatnonzero(~outside)
+        for start in xrange(0, len(inside), chunk):
+            ids = inside[start:start + chunk]
+            dist[ids] = self.walk(ox[ids], oy[ids], vx[ids], vy[ids], gx[ids], gy[ids])
+
+        return dist
+
+    def walk(self, ox, oy, vx, vy, gx, gy):
+        # Grid traversal (Amanatides & Woo) for all the rays at once
+        cx = np.clip(np.floor(gx).astype(int), 0, self.nx - 1)
+        cy = np.clip(np.floor(gy).astype(int), 0, self.ny - 1)
+        stepX, stepY = np.sign(vx).astype(int), np.sign(vy).astype(int)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tDeltaX = np.where(vx != 0, self.cellSize / np.abs(vx), np.inf)
+            tDeltaY = np.where(vy != 0, self.cellSize / np.abs(vy), np.inf)
+            tMaxX = np.where(vx != 0, ((cx + (vx > 0)) * self.cellSize + self.x0 - ox) / vx, np.inf)
+            tMaxY = np.where(vy != 0, ((cy + (vy > 0)) * self.cellSize + self.y0 - oy) / vy, np.inf)
+
+        best = np.empty(len(ox))
+        best.fill(np.inf)
+        active = np.arange(len(ox))
+
+        while len(active) > 0:
+            a = active
+            cells = cy[a]*self.nx + cx[a]
+            x, y, dx, dy = ox[a, None], oy[a, None], vx[a, None], vy[a, None]
+
+            ids = self.cellSegments[cells]
+            t = segmentsHits(x, y, dx, dy, self.segments[ids])
+            t[ids < 0] = np.inf
+            best[a] = np.minimum(best[a], t.min(axis=1))
+
+            ids = self.cellEllipses[cells]
+            if len(self.ellipses) > 0:
+                t = ellipsesHits(x, y, dx, dy, self.ellipses[ids])
+                t[ids < 0] = np.inf
+                best[a] = np.minimum(best[a], t.min(axis=1))
+
+            # A hit is confirmed if it's inside the current cell (nothing closer can be found further)
+            tExit = np.minimum(tMaxX[a], tMaxY[a])
+            goX = tMaxX[a] < tMaxY[a]
+            cx[a] += np.where(goX, stepX[a], 0)
+            cy[a] += np.where(goX, 0, stepY[a])
+            tMaxX[a] += np.where(goX, tDeltaX[a], 0)
+            tMaxY[a] += np.where(goX, 0, tDeltaY[a])
+
+            inGrid = (cx[a] >= 0) & (cx[a] < self.nx) & (cy[a] >= 0) & (cy[a] < self.ny)
+            active = a[(best[a] > tExit) & inGrid & np.isfinite(tExit)]
+
+        return best
+
+
 if __name__ == "__main__":
 
     # seg1 = Segment(0, 0, 1, 1)
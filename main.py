@@ -16,9 +16,28 @@ from probability import ParticleFilter
 from widgets import NotificationTooltip
 
 from engine import Car
+from astar import DiscreteMap
 import datetime
 import time
 
+
+class RayTableThread(QThread):
+    """ Loads (or builds, which takes a few seconds) a map's ray table away from the GUI's thread """
+
+    def __init__(self, svgMap, parent=None):
+        super(RayTableThread, self).__init__(parent)
+        self.svgMap = svgMap
+        self.table = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.table = self.svgMap.prepareRayTable()
+        except (IOError, OSError, ValueError) as e:
+            # (An unreadable table file, for instance)
+            self.error = e
+
+
 class MainWindow(QMainWindow):
     AUTO_MODE = 0
     MANUAL_MODE = 1
@@ -49,6 +68,12 @@ class MainWindow(QMainWindow):
         setScale = fileMenu.addAction("Set map's scale")
         setAngle = fileMenu.addAction("Set map's orientation")
 
+        # Precomputing the ray distances used by the particle filter (saved next to the map)
+        self.rayTableAction = fileMenu.addAction("Precompute ray distances")
+        self.rayTableAction.setCheckable(True)
+        self.rayTableAction.setChecked(False)
+        self.rayTableThread = None
+
         quitAction = fileMenu.addAction("E&xit")
         quitAction.setShortcut("Ctrl+Q")
 
@@ -56,6 +81,7 @@ class MainWindow(QMainWindow):
         saveAction.triggered.connect(self.saveMap)
         setScale.triggered.connect(self.setScale)
         setAngle.triggered.connect(self.setAngle)
+        self.rayTableAction.toggled.connect(self.setRayTable)
         quitAction.triggered.connect(qApp.quit)
 
         self.menuBar().addMenu(fileMenu)
@@ -83,6 +109,23 @@ class MainWindow(QMainWindow):
 
         self.menuBar().addMenu(modeMenu)
 
+        # Pathfinding algorithm menu
+        pathfindingMenu = QMenu("&Pathfinding", self)
+        self.algorithm = DiscreteMap.astar
+        algorithmGroup = QActionGroup(self)
+
+        for name, algorithm in [("A*", DiscreteMap.astar), ("Jump Point Search", DiscreteMap.jps),
+                                ("Hierarchical (HPA*)", DiscreteMap.hpa),
+                                ("Any-angle, shorter but slower (Theta*)", DiscreteMap.thetastar),
+                                ("Incremental (D* Lite)", DiscreteMap.dstarlite), ("Flow field", DiscreteMap.flowfield)]:
+            action = pathfindingMenu.addAction(name)
+            action.setCheckable(True)
+            action.setChecked(algorithm == self.algorithm)
+            action.triggered.connect(lambda checked=False, algorithm=algorithm: self.setAlgorithm(algorithm))
+            algorithmGroup.addAction(action)
+
+        self.menuBar().addMenu(pathfindingMenu)
+
         # Stacked widget (containing the auto. and manual view)
         self.stackedWidget = QStackedWidget()
         self.stackedWidget.addWidget(self.automaticView)
@@ -147,6 +190,50 @@ class MainWindow(QMainWindow):
         self.automaticView.scene().setMapScale()
         self.car.updateMap()
 
+    def setAlgorithm(self, algorithm):
+        self.algorithm = algorithm
+        svgMap = self.automaticView.scene().map
+        if svgMap is not None:
+            svgMap.discreteMap.algorithm = algorithm
+
+    def setRayTable(self, enable):
+        svgMap = self.automaticView.scene().map
+        if svgMap is None:
+            return
+
+        if not enable:
+            svgMap.rayTable = None
+        elif self.rayTableThread is None or not self.rayTableThread.isRunning():
+            # (If one is already being prepared, rayTableReady starts again with the current map)
+            self.notify("Precomputing ray distances...", type=NotificationTooltip.information)
+            self.rayTableThread = RayTableThread(svgMap, self)
+            self.rayTableThread.finished.connect(self.rayTableReady)
+            self.rayTableThread.start()
+
+    def rayTableReady(self):
+        svgMap, table, error = self.rayTableThread.svgMap, self.rayTableThread.table, self.rayTableThread.error
+        if not self.rayTableAction.isChecked():
+            return
+
+        if table is None:
+            # (Unchecking the action, as nothing is used)
+            self.rayTableAction.setChecked(False)
+            self.notify("Couldn't prepare the ray distances : {}".format(error), type=NotificationTooltip.error)
+            return
+
+        if svgMap is not self.automaticView.scene().map:
+            # Another map was opened meanwhile
+            self.setRayTable(True)
+            return
+
+        svgMap.rayTable = table
+        if table.saveError is not None:
+            self.notify("Using precomputed ray distances ({:.1f} MB), but they couldn't be saved : {}".format(
+                        table.memoryUsage() / 1024.**2, table.saveError), type=NotificationTooltip.error)
+        else:
+            self.notify("Using precomputed ray distances ({:.1f} MB)".format(table.memoryUsage() / 1024.**2),
+                        type=NotificationTooltip.information)
+
     def saveLog(self):
         with open("log.html", 'w+') as logFile:
             logFile.write(self.log.logEdit.toHtml())
@@ -221,6 +308,7 @@ class MainWindow(QMainWindow):
 
             self.car.update()
 
+            self.automaticView.scene().stopSearch()
             self.car.updateMap()
 
             self.config.accept()
@@ -271,7 +359,9 @@ class MainWindow(QMainWindow):
                 return
 
             self.svgMap = SvgTree(svgFile.fileName(), radius=max(self.car.width, self.car.length))
+            self.svgMap.discreteMap.algorithm = self.algorithm
             self.automaticView.openMap(self.svgMap)
+            self.setRayTable(self.rayTableAction.isChecked())
 
             if not path.startswith(':/'):
                 self.currentPath = path
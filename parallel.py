@@ -0,0 +1,140 @@
+# -*- coding: utf8 -*-
+
+"""
+    parallel.py - a particle filter whose particles are split into shards, moved and weighted
+    by a pool of processes (for very large numbers of particles).
+"""
+
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+
+from probability import ParticleFilter
+
+
+# Worker processes' state (inherited when the pool is forked)
+worker = {}
+
+
+def initWorker(particleFilter, buffers):
+    worker['filter'] = particleFilter
+    worker['arrays'] = dict((name, np.frombuffer(buffer, dtype=float)) for name, buffer in buffers.items())
+
+
+def moveShard(args):
+    start, end, distance, displacementNoise, seed = args
+    arrays, particleFilter = worker['arrays'], worker['filter']
+
+    xs, ys = particleFilter.displaced(arrays['xs'][start:end], arrays['ys'][start:end], arrays['angles'][start:end],
+                                      distance, displacementNoise, np.random.RandomState(seed))
+    arrays['xs'][start:end] = xs
+    arrays['ys'][start:end] = ys
+
+
+def senseShard(args):
+    start, end, angle, servoAngles, measuredDists, sensorNoise, mode = args
+    arrays, particleFilter = worker['arrays'], worker['filter']
+
+    logProbas = particleFilter.scanLogLikelihoods(arrays['xs'][start:end], arrays['ys'][start:end], angle,
+                                                  servoAngles, measuredDists, sensorNoise)
+    if mode == ParticleFilter.simple:
+        arrays['logWeights'][start:end] = logProbas
+    elif mode == ParticleFilter.markov:
+        arrays['logWeights'][start:end] += logProbas
+
+
+class ShardedParticleFilter(ParticleFilter):
+    """
+    Same filter, with the particles' arrays in shared memory : each process of a pool moves and
+    weights its own slice of them (nothing but the parameters is sent to the processes). Normalizing,
+    resampling and the relevance stay in the main process.
+    """
+
+    names = ['xs', 'ys', 'angles', 'logWeights']
+
+    # Shards per process (more, smaller shards balance the load better)
+    def_shards = 2
+
+    def __init__(self, car, map=None, processes=None, shards=def_shards, **kwargs):
+        self.processes = processes if processes is not None else multiprocessing.cpu_count()
+        self.shards = shards * self.processes
+        self.pool = None
+        self.poolKey = None
+
+        # Shared buffers (with room for 'capacity' particles) and the number of values used in each
+        self.capacity = 0
+        self.buffers = dict()
+        self.arrays = dict()
+        self.lengths = dict((name, 0) for name in ShardedParticleFilter.names)
+        self.allocate(max(kwargs.get('n', ParticleFilter.def_n), kwargs.get('nMax', ParticleFilter.def_nMax)))
+
+        super(ShardedParticleFilter, self).__init__(car, map, **kwargs)
+
+    def allocate(self, capacity):
+        """(Re)allocates the shared buffers (the pool is then restarted, to share the new ones)"""
+        buffers = dict((name, RawArray('d', capacity)) for name in ShardedParticleFilter.names)
+        arrays = dict((name, np.frombuffer(buffer, dtype=float)) for name, buffer in buffers.items())
+        for name in self.arrays:
+            arrays[name][:self.lengths[name]] = self.arrays[name][:self.lengths[name]]
+
+        self.capacity, self.buffers, self.arrays = capacity, buffers, arrays
+        self.close()
+
+    def shared(name):
+        # The particles' arrays are views of the shared buffers : assigning one copies it there
+        def get(self):
+            return self.arrays[name][:self.lengths[name]]
+
+        def set(self, values):
+            values = np.asarray(values, dtype=float)
+            if len(values) > self.capacity:
+                self.allocate(2 * len(values))
+            self.arrays[name][:len(values)] = values
+            self.lengths[name] = len(values)
+
+        return property(get, set)
+
+    xs, ys, angles, logWeights = [shared(name) for name in names]
+    del shared
+
+    def start(self):
+        """Starts the pool (if the map changed, the processes are restarted to get the new one)"""
+        key = (id(self.map), id(self.map.rayTable), self.width, self.height, self.map.pixel_per_mm,
+               self.map.north_angle)
+        if self.pool is not None and key == self.poolKey:
+            return
+
+        self.close()
+        self.pool = multiprocessing.Pool(self.processes, initializer=initWorker, initargs=(self, self.buffers))
+        self.poolKey = key
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def slices(self):
+        n = len(self.xs)
+        bounds = np.linspace(0, n, min(self.shards, max(n, 1)) + 1).astype(int)
+        return zip(bounds[:-1], bounds[1:])
+
+    def move(self, distance):
+        if self.ekf is not None:
+            return ParticleFilter.move(self, distance)
+        if len(self.xs) == 0:
+            return
+        self.start()
+        seeds = np.random.randint(0, 2**31 - 1, self.shards)
+        self.pool.map(moveShard, [(start, end, distance, self.car.displacement_noise, seed)
+                                  for (start, end), seed in zip(self.slices(), seeds)])
+
+    def senseScan(self, readings, angle):
+        if self.ekf is not None:
+            return ParticleFilter.senseScan(self, readings, angle)
+        if len(self.xs) == 0:
+            return
+        self.start()
+        servoAngles, measuredDists = self.beams(readings)
+        self.pool.map(senseShard, [(start, end, angle, servoAngles, measuredDists, self.car.sensor_noise, self.mode)
+                                   for start, end in self.slices()])
@@ -1,68 +1,207 @@
 """
-    probability.py - all probability-related models (particle filter, ...)
+    probability.py - all probability-related models (particle filter, extended Kalman filter, ...)
 """
 
 import math
-import copy
 from math import cos, sin, exp, pi, sqrt, radians
-import random
-import svg
-import engine
+import numpy as np
+import scipy.ndimage
+from astar import Cell
 
 
 def Gaussian(mu, sigma, x):
     # calculates the probability of x for 1-dim Gaussian with mean mu and var. sigma
-    return exp(- ((mu - x) ** 2) / (sigma ** 2) / 2.0) / sqrt(2.0 * pi * (sigma ** 2 ))
+    # (works both with numbers and NumPy arrays)
+    return np.exp(- ((mu - x) ** 2) / (sigma ** 2) / 2.0) / sqrt(2.0 * pi * (sigma ** 2 ))
+
+
+def LogGaussian(mu, sigma, x):
+    # logarithm of Gaussian(mu, sigma, x) (doesn't underflow far from the mean)
+    return - ((mu - x) ** 2) / (sigma ** 2) / 2.0 - math.log(sqrt(2.0 * pi * (sigma ** 2)))
+
+
+def logSumExp(values):
+    # log(sum(exp(values))), without overflows or underflows
+    if len(values) == 0:
+        return -np.inf
+    top = values.max()
+    if not np.isfinite(top):
+        return top
+    return top + math.log(np.exp(values - top).sum())
 
 
 class ParticleFilter(object):
     simple, markov = 0, 1
+    # Resampling schemes
+    multinomial, systematic, stratified = range(3)
     DecentRelevance = 0.75
 
     """A particle filter that calculates localization probability
-    based on a series of (noisy) measurements and displacements"""
-
-    def __init__(self, car, map=None, initAngle=0, n=100, mode=simple, randomness=0.0):
+    based on a series of (noisy) measurements and displacements.
+    The particles are stored as a structure of arrays (x, y, angle, weight), and every step
+    is done on the whole arrays at once."""
+
+    # Default number of particles
+    def_n = 2000
+
+    # KLD-sampling : bounds of the number of particles, bins' size (in mm and radians),
+    # maximal error and standard normal quantile of the bound's confidence (here, 99%)
+    def_nMin = 300
+    def_nMax = 10000
+    def_binSize = 50.
+    def_binAngle = radians(15)
+    def_kldError = 0.05
+    def_kldQuantile = 2.326
+
+    # Number of pose hypotheses reported
+    def_hypotheses = 3
+
+    # In markov mode, particles are only resampled when the effective sample size drops below this fraction of N
+    def_essThreshold = 0.5
+
+    # Tracking : weight share of the best hypothesis needed to hand off to the Kalman filter, and fraction of
+    # the particles spawned anywhere (rather than around the last pose) when handing back
+    def_trackingWeight = 0.9
+    def_recovery = 0.5
+
+    def __init__(self, car, map=None, initAngle=0, n=def_n, mode=simple, randomness=0.0, resampling=systematic,
+                 adaptive=False, nMin=def_nMin, nMax=def_nMax, tracking=False):
         self.car = car
-        self.N = n
         self.initAngle = initAngle
-        self.particles = list()
         self.mode = mode
         self.randomness = randomness
+        self.resampling = resampling
+
+        # With 'adaptive', the number of particles (N) is chosen at each resampling (KLD-sampling)
+        self.adaptive = adaptive
+        self.nMin, self.nMax = nMin, nMax
+        self.binSize, self.binAngle = ParticleFilter.def_binSize, ParticleFilter.def_binAngle
+        self.kldError, self.kldQuantile = ParticleFilter.def_kldError, ParticleFilter.def_kldQuantile
+
+        # Particles are spawned out of the obstacles, or (with spawnReachable) where the car fits ;
+        # with spawnAround (a position in pixels), only in the area connected to it
+        self.spawnReachable = False
+        self.spawnAround = None
+
+        self.essThreshold = ParticleFilter.def_essThreshold
+        self.stats = {'resampled': 0, 'skipped': 0, 'tracked': 0}
+
+        # With 'tracking', once localized, the pose is followed by an extended Kalman filter (ekf) instead of
+        # the particles, until its measurements stop matching
+        self.tracking = tracking
+        self.trackingWeight, self.recovery = ParticleFilter.def_trackingWeight, ParticleFilter.def_recovery
+        self.ekf = None
+
+        # Current number of particles
+        self.initN = n
+        self.N = nMax if adaptive else n
         self.barycenter = None
+        self.relevance = 0
+
+        # Most likely poses (best first), see estimatePoses
+        self.k = ParticleFilter.def_hypotheses
+        self.hypotheses = list()
+
+        # Positions (in pixels), headings (in radians) and weights (as logarithms) of the particles
+        self.xs = np.empty(0)
+        self.ys = np.empty(0)
+        self.angles = np.empty(0)
+        self.logWeights = np.empty(0)
 
         if map is not None:
             self.setMap(map)
 
+    @property
+    def particles(self):
+        """The particles as Particle objects (built on demand : slow with many particles)"""
+        return [Particle(x, y, angle=angle, probability=p, car=self.car)
+                for x, y, angle, p in zip(self.xs, self.ys, self.angles, self.weights)]
+
+    @property
+    def weights(self):
+        """The particles' normalized weights"""
+        top = self.logWeights.max() if len(self.logWeights) > 0 else -np.inf
+        if not np.isfinite(top):
+            return np.zeros(len(self.logWeights))
+        # (Same as logSumExp, with a single exp)
+        weights = np.exp(self.logWeights - top)
+        return weights / weights.sum()
+
     def setMap(self, map):
         """Sets a map for the particle filter (and executes random population)"""
 
         self.width = map.width
         self.height = map.height
         self.map = map
+        self.ekf = None
+        self.clear()
+        self.N = self.nMax if self.adaptive else self.initN
         self.populate(self.N, self.initAngle, probability=1./self.N)
         self.check_relevance()
 
+    def clear(self):
+        self.xs = np.empty(0)
+        self.ys = np.empty(0)
+        self.angles = np.empty(0)
+        self.logWeights = np.empty(0)
+
     def reset(self):
-        del self.particles
+        self.clear()
         self.relevance = 0
+        self.hypotheses = list()
         self.barycenter = None
-        self.particles = list()
+        self.ekf = None
+        # Global localization : the most particles
+        self.N = self.nMax if self.adaptive else self.initN
         self.populate(self.N, self.initAngle, probability=1./self.N)
         self.check_relevance()
 
-
     def populate(self, N, objectAngle, probability):
         """Adds N random particles to the particle filter. (Useful at initialization)"""
-
-        for i in xrange(N):
-            x = random.randint(0, self.width - 1)
-            y = random.randint(0, self.height - 1)
-            while self.map.isObstacle(x, y):
-                x = random.randint(0, self.width - 1)
-                y = random.randint(0, self.height - 1)
-
-            self.particles.append(Particle(x, y, angle=objectAngle, probability=probability, car=self.car))
+        if N <= 0:
+            return
+
+        xs, ys = self.randomPositions(N)
+
+        self.xs = np.concatenate([self.xs, xs])
+        self.ys = np.concatenate([self.ys, ys])
+        self.angles = np.concatenate([self.angles, np.empty(N)])
+        self.angles[-N:] = objectAngle
+        self.logWeights = np.concatenate([self.logWeights, np.empty(N)])
+        with np.errstate(divide='ignore'):
+            self.logWeights[-N:] = math.log(probability) if probability > 0 else -np.inf
+
+    def randomPositions(self, N):
+        """N random positions, outside of the obstacles (drawn from the map's free cells)"""
+        discreteMap = self.map.discreteMap
+        div = discreteMap.division
+
+        around = None
+        if self.spawnAround is not None:
+            around = Cell(int(self.spawnAround[0] / div), int(self.spawnAround[1] / div))
+        cells = discreteMap.freeCells(self.spawnReachable, around)
+        if len(cells) == 0 and around is not None:
+            # The prior position isn't in a free area
+            cells = discreteMap.freeCells(self.spawnReachable)
+
+        if len(cells) == 0:
+            # No free space : anywhere will do
+            return (np.random.randint(0, self.width, N).astype(float),
+                    np.random.randint(0, self.height, N).astype(float))
+
+        xs, ys = np.empty(N), np.empty(N)
+        missing = np.arange(N)
+        for attempt in xrange(100):
+            # Random positions in random free cells (a few, on the obstacles' borders, are drawn again)
+            cys, cxs = np.divmod(np.random.choice(cells, len(missing)), discreteMap.width)
+            xs[missing] = np.minimum(np.floor((cxs + np.random.random(len(missing))) * div), self.width - 1)
+            ys[missing] = np.minimum(np.floor((cys + np.random.random(len(missing))) * div), self.height - 1)
+
+            missing = missing[self.map.areObstacles(xs[missing], ys[missing])]
+            if len(missing) == 0:
+                break
+
+        return xs, ys
 
     def sense(self, measuredDist, angle):
         """Updates the probabilities to match a measurement.
@@ -70,112 +209,428 @@ class ParticleFilter(object):
         and takes into account the sensor's noise.
         measuredDist is in mm.
         """
+        self.senseScan([(0., measuredDist)], angle)
 
-        for particle in self.particles:
-            particleDist = self.map.rayDistance(particle.x, particle.y, angle)
+    def senseScan(self, readings, angle):
+        """Updates the probabilities to match a sweep of the sensor.
+        readings are (servo angle, distance) pairs : servo angles are in degrees, relative to the car's
+        heading (positive to the left, like the car's angle), and distances in mm (None if nothing was hit).
+        All the beams are evaluated for all the particles at once, and their likelihoods multiplied.
+        """
+        servoAngles, measuredDists = self.beams(readings)
+        if self.ekf is not None:
+            self.ekf.update(servoAngles, measuredDists, angle)
+            return
 
-            # Those two tests are here just out of caution. distances shouldn't be None
-            if particleDist is None:
-                particleDist = self.width + self.height
-            if measuredDist is None:
-                measuredDist = self.width + self.height
+        newLogProbas = self.scanLogLikelihoods(self.xs, self.ys, angle, servoAngles, measuredDists,
+                                               self.car.sensor_noise)
 
-            newProba = Gaussian(particleDist, self.car.sensor_noise, measuredDist)
+        if self.mode == ParticleFilter.simple:
+            self.logWeights = newLogProbas
+        elif self.mode == ParticleFilter.markov:
+            self.logWeights = self.logWeights + newLogProbas
 
-            if self.mode == ParticleFilter.simple:
-                particle.p = newProba
-            elif self.mode == ParticleFilter.markov:
-                particle.p *= newProba
+    def beams(self, readings):
+        """The servo angles (in radians) and the distances (in mm) of a sweep's readings"""
+        servoAngles = np.array([radians(servoAngle) for servoAngle, distance in readings])
+
+        # Those two tests are here just out of caution. distances shouldn't be None (or infinite)
+        measuredDists = np.array([distance if distance is not None else self.width + self.height
+                                  for servoAngle, distance in readings], dtype=float)
+
+        return servoAngles, measuredDists
+
+    def scanLogLikelihoods(self, xs, ys, angle, servoAngles, measuredDists, sensorNoise):
+        """Log-likelihood of the beams for the particles at (xs, ys)"""
+
+        # One row per particle, one column per beam
+        particleDists = self.map.expectedDistances(xs[:, np.newaxis], ys[:, np.newaxis],
+                                                   angle + servoAngles[np.newaxis, :])
+        particleDists[~np.isfinite(particleDists)] = self.width + self.height
+
+        # (In log space : products of many small probabilities would underflow)
+        return LogGaussian(particleDists, sensorNoise, measuredDists[np.newaxis, :]).sum(axis=1)
 
     def setAngle(self, angle):
         """
         Turns all the particles to a particular angle
         """
-        for particle in self.particles:
-            angularNoise = random.gauss(0.0, math.radians(self.car.rotation_noise))
-            particle.angle = angle + angularNoise
+        if self.ekf is not None:
+            self.ekf.setAngle(angle)
+        self.angles = angle + np.random.normal(0.0, math.radians(self.car.rotation_noise), len(self.angles))
 
     def move(self, distance):
         """Updates the probabilities to match a displacement.
         Updates the particles' coordinates (taking into account 'noise')
         """
+        if self.ekf is not None:
+            self.ekf.predict(distance)
+            return
+        self.xs, self.ys = self.displaced(self.xs, self.ys, self.angles, distance, self.car.displacement_noise)
 
-        for particle in self.particles:
-            # ...  and it's position
-            distanceNoise = random.gauss(0.0, (self.car.displacement_noise/100.)*distance)
-            deltaDistance = distance + distanceNoise
-            particle.move(deltaDistance)
+    def displaced(self, xs, ys, angles, distance, displacementNoise, rand=np.random):
+        """Positions of the particles (xs, ys, angles) after a (noisy) displacement"""
+        distanceNoise = rand.normal(0.0, abs((displacementNoise/100.)*distance), len(xs))
+        displacement = (distance + distanceNoise) * self.map.pixel_per_mm
+        heading = angles - radians(self.map.north_angle)
 
-            # If the particle goes out of the universe, we put it on the border
-            particle.x = min(max(0, particle.x), self.width - 1)
-            particle.y = min(max(0, particle.y), self.height - 1)
+        # If a particle goes out of the universe, we put it on the border
+        return (np.clip(xs - displacement * np.sin(heading), 0, self.width - 1),
+                np.clip(ys - displacement * np.cos(heading), 0, self.height - 1))
 
     def normalize(self):
         """Normalizes the particles's weights.
         (Makes the sum of all probabilities equal to 1)
         """
-        sumProba = 0
-        for particle in self.particles:
-            sumProba += particle.p
+        logSum = logSumExp(self.logWeights)
+
+        if np.isfinite(logSum):
+            self.logWeights = self.logWeights - logSum
+
+    def resampleIndexes(self, n):
+        """Indexes of n particles drawn proportionally to their weights, in a single pass over the
+        cumulated weights. The draw's positions on [0, 1) are either independent (multinomial), one per
+        stratum of size 1/n (stratified), or evenly spaced with a single random offset (systematic, the
+        lowest variance)."""
+        count = len(self.logWeights)
+        cumulated = np.cumsum(self.weights)
+        if count == 0:
+            return np.empty(0, dtype=int)
+        elif cumulated[-1] <= 0:
+            # All the weights are null : any particle will do
+            return np.random.randint(0, count, n)
+
+        if self.resampling == ParticleFilter.systematic:
+            positions = (np.random.random() + np.arange(n)) / n
+        elif self.resampling == ParticleFilter.stratified:
+            positions = (np.random.random(n) + np.arange(n)) / n
+        else:
+            positions = np.random.random(n)
+
+        indexes = np.searchsorted(cumulated, positions * cumulated[-1], side='right')
+        return np.minimum(indexes, count - 1)
+
+    def kldCount(self, indexes):
+        """KLD-sampling : the number of the (randomly ordered) particles 'indexes' to keep, so that the
+        sample approximates the posterior within kldError (with the kldQuantile's confidence).
+        The bound grows with the number of (x, y, heading) bins the first particles fall into."""
+        binSize = self.binSize * self.map.pixel_per_mm
+        nx, ny = int(self.width / binSize) + 1, int(self.height / binSize) + 1
+        na = int(2*pi / self.binAngle) + 1
+
+        bx = (self.xs[indexes] / binSize).astype(int)
+        by = (self.ys[indexes] / binSize).astype(int)
+        ba = ((self.angles[indexes] % (2*pi)) / self.binAngle).astype(int)
+        bins = (bx*ny + by)*na + ba
+
+        # Number of distinct bins among the first i + 1 particles
+        firsts = np.zeros(len(bins), dtype=int)
+        firsts[np.unique(bins, return_index=True)[1]] = 1
+        k = np.cumsum(firsts)
+
+        # Wilson-Hilferty approximation of the chi-square quantile
+        k1 = np.maximum(k - 1, 1)
+        a = 2. / (9*k1)
+        required = k1 / (2*self.kldError) * (1 - a + np.sqrt(a)*self.kldQuantile)**3
+        required = np.maximum(np.where(k > 1, required, 0), self.nMin)
+
+        enough = np.flatnonzero(np.arange(1, len(bins) + 1) >= required)
+        return int(enough[0]) + 1 if len(enough) > 0 else len(bins)
+
+    def effectiveSampleSize(self):
+        """1 / sum(w**2) (for normalized weights) : N when all the particles are equally weighted,
+        1 when a single one carries all the weight"""
+        weights = self.weights
+        squares = (weights**2).sum()
+        return weights.sum()**2 / squares if squares > 0 else 0.
+
+    def resample(self, force=False):
+        """Resampling the particles proportionally to their weights (see resampleIndexes),
+        then replacing some of them by random ones (see randomness).
+        In markov mode, it's skipped (unless forced) while the effective sample size stays above
+        essThreshold * N : the weights keep accumulating the measurements instead.
+        While tracking, the Kalman filter is handed back to the particles when it's lost.
+        Returns True if the particles were resampled."""
+
+        if self.ekf is not None:
+            self.stats['tracked'] += 1
+            if not self.ekf.lost:
+                self.check_relevance()
+                return False
+            self.stopTracking()
+            return True
+
+        if not force and self.mode == ParticleFilter.markov and \
+                self.effectiveSampleSize() >= self.essThreshold * len(self.logWeights):
+            self.stats['skipped'] += 1
+            self.normalize()
+            self.check_relevance()
+            self.startTracking()
+            return False
+        self.stats['resampled'] += 1
+
+        if self.adaptive:
+            # Drawing as many particles as allowed (in random order) and keeping the ones needed
+            indexes = np.random.permutation(self.resampleIndexes(self.nMax))
+            self.N = self.kldCount(indexes)
+            indexes = indexes[:int(self.N*(1.0 - self.randomness))]
+            n_resampled = len(indexes)
+        else:
+            n_resampled = int(self.N*(1.0 - self.randomness))
+            indexes = self.resampleIndexes(n_resampled)
+
+        # The resampled particles are equally weighted (their weight is now in their number)
+        self.xs, self.ys, self.angles = self.xs[indexes], self.ys[indexes], self.angles[indexes]
+        self.logWeights = np.zeros(len(indexes))
+
+        if len(self.xs) > 0:
+            self.check_relevance()
 
-        if sumProba != 0:
-            for particle in self.particles:
-                particle.p /= sumProba
+        # Adding some random particles
+        n_new_particles = self.N - n_resampled
+        angle = self.angles[-1] if len(self.angles) > 0 else self.initAngle
+        self.populate(n_new_particles, angle, probability=1.)
 
-    def resample(self):
-        """Resampling the particles using a 'resampling wheel' algorithm."""
+        self.normalize()
+        self.startTracking()
+        return True
+
+    def startTracking(self):
+        """Hands off to the Kalman filter (starting from the best hypothesis) if the particles have
+        converged to a single pose"""
+        if not self.tracking or self.ekf is not None or not self.hypotheses:
+            return
+
+        best = self.hypotheses[0]
+        if self.relevance < ParticleFilter.DecentRelevance or best.weight < self.trackingWeight:
+            return
+
+        # (Summed from the particles, the covariance can be slightly indefinite : only its eigenvalues are clamped,
+        # its orientation is kept)
+        values, vectors = np.linalg.eigh(best.covariance)
+        covariance = (vectors * np.maximum(values, 0)).dot(vectors.T)
+
+        # (The resampled particles can be much closer than the relevance needs : they would be overconfident)
+        spread = (0.25 * self.car.length * self.map.pixel_per_mm)**2 / 2
+        self.ekf = ExtendedKalmanFilter(self.car, self.map, best.x, best.y, covariance + spread*np.eye(2), best.angle)
+        self.clear()
+        self.check_relevance()
 
-        newParticles = list()
-        maxProba = max(particle.p for particle in self.particles)
-        meanProba = sum(particle.p for particle in self.particles) / self.N
+    def stopTracking(self):
+        """Hands back to the particles : some around the Kalman filter's last pose, the others anywhere
+        (the car may have been moved)"""
+        x, y, angle = self.ekf.x, self.ekf.y, self.ekf.angle
+        covariance = self.ekf.covariance + (self.car.length * self.map.pixel_per_mm)**2 * np.eye(2)
+        self.ekf = None
+
+        self.N = self.nMax if self.adaptive else self.initN
+        n = int(self.N * (1.0 - self.recovery))
+        positions = np.random.multivariate_normal([x, y], covariance, n)
+        self.xs = np.clip(positions[:, 0], 0, self.width - 1)
+        self.ys = np.clip(positions[:, 1], 0, self.height - 1)
+        self.angles = np.ones(n) * angle
+        self.logWeights = np.zeros(n)
+        self.populate(self.N - n, angle, probability=1.)
 
-        index = random.randint(0, len(self.particles) - 1)
-        B = 0.0
+        self.normalize()
+        self.check_relevance()
 
-        n_resampled = int(self.N*(1.0 - self.randomness))
-        for i in xrange(n_resampled):
-            B += random.random() * 2 * maxProba
+    def check_relevance(self):
+        if self.ekf is not None:
+            # A single hypothesis : the Kalman filter's pose
+            self.hypotheses = [Hypothesis(self.ekf.x, self.ekf.y, self.ekf.angle, self.ekf.covariance, 1.)]
+            self.barycenter = Particle(self.ekf.x, self.ekf.y, angle=self.ekf.angle, probability=1.)
+            spread = sqrt(np.trace(self.ekf.covariance)) / self.map.pixel_per_mm
+            self.relevance = min(1., max(0., 1. - spread / self.car.length))
+            return
+
+        if len(self.xs) == 0:
+            return
+
+        weights = self.weights
+        if weights.sum() == 0:
+            weights = np.ones(len(self.xs)) / len(self.xs)
+
+        # The barycenter is the most likely pose (a barycenter of all the particles could be in a wall)
+        self.hypotheses = self.estimatePoses(weights)
+        best = self.hypotheses[0]
+        self.barycenter = Particle(best.x, best.y, angle=best.angle, probability=best.weight)
+
+        # Mean squared distance to the best pose, from the weighted moments (normalized weights). Its root, times
+        # sqrt(pi)/2, is the mean distance for a Gaussian cloud
+        meanSquare = weights.dot(self.xs**2 + self.ys**2) - 2*(best.x*weights.dot(self.xs) + best.y*weights.dot(self.ys)) \
+                     + best.x**2 + best.y**2
+        bMeanDist = sqrt(pi * max(meanSquare, 0.)) / 2 / self.map.pixel_per_mm
+        self.relevance = min(1., max(0., 1. - bMeanDist / self.car.length))
 
-            while self.particles[index].p < B:
-                B -= self.particles[index].p
-                index = (index + 1) % len(self.particles)
+    def estimatePoses(self, weights):
+        """The k most likely poses : the particles' weights are summed in bins (the car's size), the heaviest
+        bins (local maximums) are the hypotheses' seeds, and each bin's particles go to the closest seed (if it's
+        at most two bins away). Returns Hypothesis objects, best first."""
+        binSize = max(1., self.car.length * self.map.pixel_per_mm)
+        nx, ny = int(self.width / binSize) + 1, int(self.height / binSize) + 1
+
+        bx = np.minimum((self.xs * (1. / binSize)).astype(int), nx - 1)
+        by = np.minimum((self.ys * (1. / binSize)).astype(int), ny - 1)
+        bins = by*nx + bx
+
+        # The particles' weighted moments are summed per bin, once : weight, x, y, x*x, y*y, x*y, and the headings' sine
+        # and cosine (in single precision : a third of the time, and plenty for a mean heading). The hypotheses then
+        # sum their bins' ones.
+        wx, wy = weights * self.xs, weights * self.ys
+        angles = self.angles.astype(np.float32)
+        moments = np.array([np.bincount(bins, weights=values, minlength=nx*ny)
+                            for values in [weights, wx, wy, wx * self.xs, wy * self.ys, wx * self.ys,
+                                           weights * np.sin(angles), weights * np.cos(angles)]])
+        binWeights = moments[0].reshape(ny, nx)
+
+        # Seeds : the heaviest bins among their neighbours
+        peaks = (binWeights == scipy.ndimage.maximum_filter(binWeights, size=3, mode='constant')) & (binWeights > 0)
+        candidates = np.flatnonzero(peaks)
+        seeds = candidates[np.argsort(binWeights.ravel()[candidates])[::-1][:self.k]]
+        if len(seeds) == 0:
+            seeds = np.array([np.argmax(binWeights)])
+        seedsY, seedsX = np.divmod(seeds, nx)
+
+        # Each bin goes to the closest seed (if it's at most two bins away)
+        binsY, binsX = np.divmod(np.arange(nx*ny), nx)
+        dist = np.hypot(binsX[:, np.newaxis] - seedsX, binsY[:, np.newaxis] - seedsY)
+        binLabels = dist.argmin(axis=1)
+        binLabels[dist.min(axis=1) > 2] = len(seeds)
+
+        # Weighted sums per hypothesis
+        count = len(seeds) + 1
+        w, sx, sy, sxx, syy, sxy, sines, cosines = [np.bincount(binLabels, weights=values, minlength=count)[:len(seeds)]
+                                                    for values in moments]
+
+        w[w == 0] = np.finfo(float).tiny
+        mx, my = sx / w, sy / w
+        cxx, cyy, cxy = sxx / w - mx**2, syy / w - my**2, sxy / w - mx*my
+        angles = np.arctan2(sines, cosines)
+
+        total = moments[0].sum()
+        hypotheses = [Hypothesis(mx[i], my[i], angles[i], np.array([[cxx[i], cxy[i]], [cxy[i], cyy[i]]]), w[i] / total)
+                      for i in xrange(len(seeds))]
+        hypotheses.sort(key=lambda hypothesis: -hypothesis.weight)
+
+        return hypotheses
 
-            newParticles.append(copy.copy(self.particles[index]))
+    def __repr__(self):
+        return '\n'.join(particle.__repr__() for particle in self.particles)
 
-        self.particles = newParticles
 
-	if len(self.particles) > 0:
-            self.check_relevance()
+class ExtendedKalmanFilter(object):
+    """Tracks a single pose : the position (in pixels) is a Gaussian (mean, covariance), and the heading is the
+    (noisy) compass' one. Uses the car's noises and the same measurement model as the particle filter :
+    the expected distances are cast from the mean, and linearized around it by finite differences.
+    A sweep whose innovation is too unlikely (normalized, beyond the gate's chi-square quantile) is ignored ;
+    after maxFailures of them in a row, the filter is lost."""
 
-        # Adding some random particles
-        n_new_particles = self.N - n_resampled
-        self.populate(n_new_particles, self.particles[-1].angle, probability=meanProba)
+    # Finite differences' step (in pixels)
+    def_step = 2.
+    # Gate : standard normal quantile of the chi-square's one (here, 99%)
+    def_gateQuantile = 2.326
+    def_maxFailures = 3
 
-        self.normalize()
+    def __init__(self, car, map, x, y, covariance, angle=0.):
+        self.car = car
+        self.map = map
+        self.mean = np.array([x, y], dtype=float)
+        self.covariance = np.array(covariance, dtype=float)
+        self.angle = angle
 
-    def check_relevance(self):
-        # Barycenter
-        bX, bY = 0., 0.
-        numParticles = len(self.particles)
+        self.step, self.gateQuantile, self.maxFailures = (ExtendedKalmanFilter.def_step,
+                                                          ExtendedKalmanFilter.def_gateQuantile,
+                                                          ExtendedKalmanFilter.def_maxFailures)
+        self.failures = 0
+        self.lost = False
 
-        for particle in self.particles:
-            bX += particle.x
-            bY += particle.y
-        bX /= numParticles
-        bY /= numParticles
+    @property
+    def x(self):
+        return self.mean[0]
 
-        self.barycenter = Particle(bX, bY)
+    @property
+    def y(self):
+        return self.mean[1]
 
-        bMeanDist = sum(particle.distance(self.barycenter) for particle in self.particles) / len(self.particles)
-        bMeanDist /= self.car.map.pixel_per_mm
-        self.relevance = min(1., max(0., 1. - bMeanDist / self.car.length))
+    def setAngle(self, angle):
+        self.angle = angle
+
+    def predict(self, distance):
+        """Moves the mean like a particle, and grows the covariance along (distance's noise)
+        and across (heading's noise) the displacement"""
+        heading = self.angle - radians(self.map.north_angle)
+        forward = np.array([-sin(heading), -cos(heading)])
+        across = np.array([-cos(heading), sin(heading)])
+        displacement = distance * self.map.pixel_per_mm
+
+        self.mean = np.clip(self.mean + displacement * forward, 0, [self.map.width - 1, self.map.height - 1])
+
+        sigmaDistance = abs((self.car.displacement_noise/100.) * distance) * self.map.pixel_per_mm
+        sigmaAcross = abs(displacement) * radians(self.car.rotation_noise)
+        self.covariance = self.covariance + sigmaDistance**2 * np.outer(forward, forward) \
+                                          + sigmaAcross**2 * np.outer(across, across)
+
+    def update(self, servoAngles, measuredDists, angle):
+        """Corrects the pose with a sweep of the sensor (servo angles in radians, distances in mm).
+        Returns False if the sweep was rejected."""
+        self.angle = angle
+        if len(servoAngles) == 0:
+            return True
+
+        # Distances from the mean and from the mean moved by +-step along x and y (one row per position).
+        # With a ray table, the step spans its cells (the distances are constant inside one)
+        x, y, step = self.mean[0], self.mean[1], self.step
+        if self.map.rayTable is not None:
+            step = max(step, self.map.rayTable.division)
+        xs = np.array([x, x + step, x - step, x, x])[:, np.newaxis]
+        ys = np.array([y, y, y, y + step, y - step])[:, np.newaxis]
+        dists = self.map.expectedDistances(xs, ys, angle + servoAngles[np.newaxis, :])
+
+        # Jacobian (mm per pixel) : one row per beam. The beams that hit nothing tell little about the position
+        jacobian = np.column_stack([(dists[1] - dists[2]) / (2*step), (dists[3] - dists[4]) / (2*step)])
+        valid = np.isfinite(dists).all(axis=0) & (measuredDists < self.map.width + self.map.height)
+        if not valid.any():
+            return True
+
+        H, innovations = jacobian[valid], (measuredDists - dists[0])[valid]
+        S = H.dot(self.covariance).dot(H.T) + self.car.sensor_noise**2 * np.eye(len(H))
+
+        # Normalized innovation against the chi-square quantile (Wilson-Hilferty approximation)
+        m = len(H)
+        gate = m * (1 - 2./(9*m) + sqrt(2./(9*m))*self.gateQuantile)**3
+        if innovations.dot(np.linalg.solve(S, innovations)) > gate:
+            self.failures += 1
+            self.lost = self.failures >= self.maxFailures
+            return False
+        self.failures = 0
+
+        K = np.linalg.solve(S, H.dot(self.covariance)).T
+
+        self.mean = np.clip(self.mean + K.dot(innovations), 0, [self.map.width - 1, self.map.height - 1])
+        covariance = (np.eye(2) - K.dot(H)).dot(self.covariance)
+        self.covariance = (covariance + covariance.T) / 2
+
+        return True
+
+    def __repr__(self):
+        return '[x = {:.0f} y = {:.0f} angle = {} degree | sigma = {:.1f}]'.format(
+            self.x, self.y, int(math.degrees(self.angle)), sqrt(np.trace(self.covariance)))
+
+
+class Hypothesis(object):
+    """A pose estimated from a cluster of particles : mean position (pixels), covariance (in pixels),
+    circular mean of the headings (radians) and the cluster's share of the weight"""
+
+    def __init__(self, x, y, angle, covariance, weight):
+        self.x, self.y = x, y
+        self.angle = angle
+        self.covariance = covariance
+        self.weight = weight
 
     def __repr__(self):
-        result = ""
-        for particle in self.particles:
-            result += particle.__repr__() + '\n'
-        result.normalize()
-        return result
+        return '[x = {:.0f} y = {:.0f} angle = {} degree | weight = {:.2f}]'.format(self.x, self.y,
+                                                                                   int(math.degrees(self.angle)), self.weight)
 
 
 class Particle(object):
@@ -205,8 +660,10 @@ class Particle(object):
 
 
 if __name__ == "__main__":
+    import svg
+    import engine
 
-    myMap = svg.SvgTree("maps/mapexamplewithborder.svg")
+    myMap = svg.SvgTree("maps/mapexample.svg", radius=0)
     myCar = engine.Car(myMap)
     proba = ParticleFilter(map=myMap, car=myCar, n=20)
 
@@ -0,0 +1,102 @@
+# -*- coding: utf8 -*-
+
+"""
+    raytable.py - precomputed distances to the closest obstacle (per map cell and heading),
+    used to speed up the particle filter's sensing.
+"""
+
+import os
+import hashlib
+import numpy as np
+from math import pi
+
+
+class RayTable(object):
+    """ Expected ray distance from the center of every cell of a grid, for every (quantized) heading.
+    Distances are stored in pixels, and headings are ray angles in the map's frame, so changing the
+    map's scale or north angle doesn't invalidate the table. """
+
+    # Cell size (in pixels) and number of heading bins
+    def_division = 5
+    def_bins = 72
+
+    def __init__(self, svgMap, division=def_division, bins=def_bins):
+        self.division = division
+        self.bins = bins
+
+        self.width = int(svgMap.width / division)
+        self.height = int(svgMap.height / division)
+
+        # Identifies the shapes the table was computed with
+        self.key = RayTable.mapKey(svgMap)
+
+        self.distances = None
+
+        # Set if the table was built but couldn't be saved
+        self.saveError = None
+
+    @staticmethod
+    def mapKey(svgMap):
+        md5 = hashlib.md5()
+        md5.update(svgMap.segments.tostring())
+        md5.update(svgMap.ellipses.tostring())
+        return md5.hexdigest()
+
+    @staticmethod
+    def filePath(svgPath):
+        """ The table is saved next to the svg file """
+        return os.path.splitext(svgPath)[0] + '.raytable.npz'
+
+    def build(self, svgMap):
+        """ Casts a ray for every cell and every heading bin """
+        ys, xs, bins = np.mgrid[0:self.height, 0:self.width, 0:self.bins]
+        ox = ((xs + 0.5) * self.division).ravel().astype(float)
+        oy = ((ys + 0.5) * self.division).ravel().astype(float)
+        angles = (bins * 2*pi / self.bins).ravel()
+
+        dist = svgMap.index.castRays(ox, oy, np.cos(angles), -np.sin(angles))
+        self.distances = dist.reshape(self.height, self.width, self.bins).astype(np.float32)
+
+    def lookup(self, xs, ys, rayAngles):
+        """ The distances (in pixels) stored for the cells containing (xs, ys) and the closest headings """
+        cx = np.clip((xs / self.division).astype(int), 0, self.width - 1)
+        cy = np.clip((ys / self.division).astype(int), 0, self.height - 1)
+        b = np.round(rayAngles * self.bins / (2*pi)).astype(int) % self.bins
+
+        return self.distances[cy, cx, b]
+
+    def memoryUsage(self):
+        """ Size of the table, in bytes """
+        return self.distances.nbytes if self.distances is not None else 0
+
+    def save(self, path):
+        np.savez(path, distances=self.distances, division=self.division, bins=self.bins, key=self.key)
+
+    def load(self, path):
+        """ Loads the table saved in 'path'. Returns False if there's none, or if it doesn't
+        match the map or the table's resolution. """
+        if not os.path.exists(path):
+            return False
+
+        with np.load(path) as data:
+            if int(data['division']) != self.division or int(data['bins']) != self.bins or str(data['key']) != self.key:
+                return False
+
+            self.distances = data['distances']
+        return self.distances.shape == (self.height, self.width, self.bins)
+
+    def __str__(self):
+        return "Ray table : {}x{} cells, {} headings, {:.1f} MB".format(self.width, self.height, self.bins,
+                                                                       self.memoryUsage() / 1024.**2)
+
+
+if __name__ == "__main__":
+    # Usage : python raytable.py map.svg [division] [bins]
+    import sys
+    import svg
+
+    svgMap = svg.SvgTree(sys.argv[1], radius=0)
+    division = int(sys.argv[2]) if len(sys.argv) > 2 else RayTable.def_division
+    bins = int(sys.argv[3]) if len(sys.argv) > 3 else RayTable.def_bins
+
+    print svgMap.loadRayTable(division, bins)
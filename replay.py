@@ -0,0 +1,209 @@
+# -*- coding: utf8 -*-
+
+"""
+    replay.py - headless localization runs : drives the particle filter with a recorded (or simulated) sequence of
+    turns, moves and sensor readings, as fast as possible and without Qt, and writes its results as JSON
+    (time to localize, position error at each step, latency of each step of the filter).
+
+    Usage : python replay.py [map.svg] [--replay events.json | --record events.json] [--steps 200] [--seed 0]
+                             [-n 2000] [--adaptive] [--tracking] [-o results.json]
+
+    A recording is a JSON object : {"map": svg file, "events": [event, ...]}, each event being
+    {"turn": radians (or "angle", the measured heading), "move": mm, "readings": [[servo angle (degrees), mm or null], ...]}
+    and, when it's known, the real position of the car after it : "x", "y" (in pixels).
+"""
+
+import os
+import json
+import time
+import random
+import argparse
+import numpy as np
+from math import pi, sin, cos, radians, hypot
+
+from svg import SvgTree
+from probability import ParticleFilter
+from benchmark import statistics
+
+modes = {'simple': ParticleFilter.simple, 'markov': ParticleFilter.markov}
+resamplings = {'multinomial': ParticleFilter.multinomial, 'systematic': ParticleFilter.systematic,
+               'stratified': ParticleFilter.stratified}
+
+
+class ReplayCar(object):
+    """
+    What the filter needs of the car (its size and its noises), without engine.Car's Qt signals.
+    The defaults are engine.Car's.
+    """
+
+    def_width = 50
+    def_length = 100
+    def_sensor = 100.
+    def_displacement = 10.
+    def_rotation = 2.
+
+    # Servo angles (in degrees) of a sweep of the sensor
+    def_sweep = range(-45, 46, 15)
+
+    def __init__(self, map, x=0, y=0, angle=0.):
+        self.map = map
+        self.x, self.y = x, y
+        self.angle = angle
+
+        self.width, self.length = ReplayCar.def_width, ReplayCar.def_length
+        self.sensor_noise = ReplayCar.def_sensor
+        self.displacement_noise = ReplayCar.def_displacement
+        self.rotation_noise = ReplayCar.def_rotation
+
+    def move(self, distance):
+        self.x += -distance * self.map.pixel_per_mm * sin(self.angle - radians(self.map.north_angle))
+        self.y += -distance * self.map.pixel_per_mm * cos(self.angle - radians(self.map.north_angle))
+
+    def scan(self, servoAngles=def_sweep):
+        distances = self.map.rayDistances(self.x, self.y, self.angle + np.radians(servoAngles))
+        return [(servoAngle, float(distance) if np.isfinite(distance) else None)
+                for servoAngle, distance in zip(servoAngles, distances)]
+
+
+def simulate(svgMap, steps, seed=0, speed=20., readingNoise=20.):
+    """ Events of a simulated car wandering on the map : it goes straight ahead, and turns in front
+    of the obstacles. The moves, turns and readings are noisy (with the car's noises) """
+    rand = random.Random(seed)
+    np.random.seed(seed)
+
+    car = ReplayCar(svgMap)
+    cells = svgMap.discreteMap.freeCells(reachable=True)
+    if len(cells) == 0:
+        cells = svgMap.discreteMap.freeCells()
+    cy, cx = divmod(cells[rand.randrange(len(cells))], svgMap.discreteMap.width)
+    car.x, car.y = (cx + 0.5) * svgMap.discreteMap.division, (cy + 0.5) * svgMap.discreteMap.division
+    car.angle = rand.uniform(-pi, pi)
+
+    events = []
+    for step in xrange(steps):
+        ahead = svgMap.rayDistance(car.x, car.y, car.angle)
+        if ahead is not None and ahead < 1.5 * car.length:
+            turn, distance = rand.choice([-1, 1]) * pi/8, 0.
+        else:
+            turn, distance = 0., speed
+
+        car.angle += turn + (rand.gauss(0., radians(car.rotation_noise)) if distance else 0.)
+        car.move(distance + rand.gauss(0., (car.displacement_noise/100.) * distance))
+
+        readings = [(servoAngle, reading + rand.gauss(0., readingNoise) if reading is not None else None)
+                    for servoAngle, reading in car.scan()]
+        events.append({'turn': turn, 'move': distance, 'readings': readings,
+                       'angle': car.angle + rand.gauss(0., radians(car.rotation_noise)), 'x': car.x, 'y': car.y})
+
+    return events
+
+
+def replay(svgMap, events, seed=0, processes=None, **kwargs):
+    """ Runs the filter (ParticleFilter's options in kwargs) over the events.
+    With processes, the sharded filter (see parallel.py) is used """
+    np.random.seed(seed)
+    car = ReplayCar(svgMap)
+
+    t = time.time()
+    if processes:
+        from parallel import ShardedParticleFilter
+        particleFilter = ShardedParticleFilter(car, svgMap, processes=processes, **kwargs)
+    else:
+        particleFilter = ParticleFilter(car, svgMap, **kwargs)
+    result = {'initTime': time.time() - t, 'steps': []}
+
+    latencies = {'turn': [], 'move': [], 'sense': [], 'resample': []}
+    angle, elapsed, localized = 0., 0., None
+    for step, event in enumerate(events):
+        angle = event['angle'] if 'angle' in event else angle + event.get('turn', 0.)
+
+        timings = []
+        for name, call, args in [('turn', particleFilter.setAngle, (angle,)),
+                                 ('move', particleFilter.move, (event.get('move', 0.),)),
+                                 ('sense', particleFilter.senseScan, (event.get('readings', []), angle)),
+                                 ('resample', particleFilter.resample, ())]:
+            t = time.time()
+            call(*args)
+            timings.append(time.time() - t)
+            latencies[name].append(1000 * timings[-1])
+        elapsed += sum(timings)
+
+        state = {'relevance': particleFilter.relevance, 'particles': len(particleFilter.xs),
+                 'tracking': particleFilter.ekf is not None}
+        if 'x' in event and particleFilter.barycenter is not None:
+            state['error'] = hypot(particleFilter.barycenter.x - event['x'],
+                                   particleFilter.barycenter.y - event['y']) / svgMap.pixel_per_mm
+        result['steps'].append(state)
+
+        if localized is None and particleFilter.relevance >= ParticleFilter.DecentRelevance:
+            localized = {'step': step, 'time': elapsed, 'error': state.get('error')}
+
+    if processes:
+        particleFilter.close()
+
+    errors = [state['error'] for state in result['steps'] if 'error' in state]
+    result.update({'localized': localized, 'time': elapsed, 'error': statistics(errors),
+                   'latency': dict((name, statistics(values)) for name, values in latencies.items()),
+                   'stats': particleFilter.stats})
+
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless localization runs")
+    parser.add_argument('map', nargs='?', help="svg map (the recording's one with --replay, maps/map2.svg otherwise)")
+    parser.add_argument('-o', '--output', help="JSON file to write (printed if not given)")
+    parser.add_argument('--replay', help="Recording to replay (instead of a simulated run)")
+    parser.add_argument('--record', help="JSON file to write the simulated run's events to")
+    parser.add_argument('--steps', type=int, default=200, help="Length of the simulated run")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reading-noise', dest='readingNoise', type=float, default=20.,
+                        help="Noise of the simulated readings (in mm)")
+    parser.add_argument('--ray-table', dest='rayTable', action='store_true', help="Use the precomputed ray distances")
+    parser.add_argument('-n', type=int, default=ParticleFilter.def_n, help="Number of particles")
+    parser.add_argument('--mode', choices=sorted(modes), default='markov')
+    parser.add_argument('--resampling', choices=sorted(resamplings), default='systematic')
+    parser.add_argument('--randomness', type=float, default=0.)
+    parser.add_argument('--adaptive', action='store_true', help="KLD-sampling of the number of particles")
+    parser.add_argument('--tracking', action='store_true', help="Hand off to the Kalman filter once localized")
+    parser.add_argument('--processes', type=int, default=0, help="Sharded filter's processes (0 : not sharded)")
+    args = parser.parse_args()
+
+    recording = None
+    if args.replay:
+        with open(args.replay) as replayFile:
+            recording = json.load(replayFile)
+
+    path = args.map or (recording or {}).get('map') or \
+           os.path.join(os.path.dirname(os.path.abspath(__file__)), 'maps', 'map2.svg')
+    svgMap = SvgTree(path, ReplayCar.def_length)
+    if args.rayTable:
+        svgMap.loadRayTable()
+
+    if recording is not None:
+        events = recording['events']
+    else:
+        events = simulate(svgMap, args.steps, args.seed, readingNoise=args.readingNoise)
+        if args.record:
+            with open(args.record, 'w') as recordFile:
+                json.dump({'map': path, 'events': events}, recordFile)
+
+    results = replay(svgMap, events, args.seed, args.processes, n=args.n, mode=modes[args.mode],
+                     resampling=resamplings[args.resampling], randomness=args.randomness,
+                     adaptive=args.adaptive, tracking=args.tracking)
+    results.update({'map': os.path.basename(path), 'events': len(events), 'seed': args.seed,
+                    'options': dict((name, getattr(args, name)) for name in ['n', 'mode', 'resampling', 'randomness',
+                                                                           'adaptive', 'tracking', 'processes',
+                                                                           'rayTable'])})
+
+    if results['localized'] is not None:
+        print "[ * ] Localized at step {} ({:.2f} s of filtering)".format(results['localized']['step'],
+                                                                        results['localized']['time'])
+    else:
+        print "[ * ] Not localized after {} steps".format(len(events))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
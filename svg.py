@@ -3,9 +3,12 @@ svg.py - module to parse geometric elements from an svg file.
 """
 
 from lxml import etree
-from geometry import Point, Rectangle, Ellipse, Polygone, Polyline, Ray
+from geometry import Point, Rectangle, Ellipse, Polygone, Polyline, ShapeGrid
 from astar import DiscreteMap, Cell
+from raytable import RayTable
 from math import radians, pi
+from collections import OrderedDict
+import numpy as np
 import re
 NS = {'svg': 'http://www.w3.org/2000/svg',
       'sodipodi': 'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd'}
@@ -34,6 +37,43 @@ def parseTransform(element):
 
     return 0, 0
 
+class PathCache(object):
+    """ A bounded cache of search results, dropping the least recently used ones first """
+
+    def_size = 64
+
+    def __init__(self, size=def_size):
+        self.size = size
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ The cached path for key (None if there's none) """
+        if key in self.entries:
+            self.hits += 1
+            # Moving the entry to the end (the most recently used)
+            path = self.entries.pop(key)
+            self.entries[key] = path
+            return path
+        else:
+            self.misses += 1
+            return None
+
+    def put(self, key, path):
+        self.entries[key] = path
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __str__(self):
+        return "Path cache : {} hits, {} misses ({}/{} entries)".format(self.hits, self.misses,
+                                                                      len(self.entries), self.size)
+
+
 class SvgTree:
 
     default_title = "Title undefined"
@@ -79,6 +119,10 @@ class SvgTree:
             else:
                 raise Exception("No {} ! Can't parse SVG.".format(attribute))
 
+        # Parsing the title
+        titles = tree.xpath("//n:title", namespaces={'n': NS['svg']})
+        self.title = titles[0].text if titles and titles[0].text else SvgTree.default_title
+
         # Parsing the map's scale
         self.pixel_per_mm = None
         if 'pixel_per_mm' in svgNode.attrib:
@@ -171,6 +215,23 @@ class SvgTree:
                 polyline = Polyline(points)
                 self.shapes.append(polyline)
 
+        # The shapes' borders and the ellipses as arrays, to cast many rays at once
+        self.segments = np.array([edge for shape in self.shapes for edge in shape.edges()],
+                                 dtype=float).reshape(-1, 4)
+        self.ellipses = np.array([[shape.center.x, shape.center.y, shape.rx, shape.ry]
+                                  for shape in self.shapes if isinstance(shape, Ellipse)],
+                                 dtype=float).reshape(-1, 4)
+
+        # Spatial index over the shapes (the bounding rectangle isn't an obstacle, but it stops rays)
+        self.index = ShapeGrid([shape for shape in self.shapes if shape is not self.rect],
+                               self.segments, self.ellipses)
+
+        # Precomputed ray distances (optional, see loadRayTable)
+        self.rayTable = None
+
+        # Last search results
+        self.pathCache = PathCache()
+
         if self.pixel_per_mm is not None:
             self.discreteMap = DiscreteMap(self, radius=int(radius*self.pixel_per_mm))
         else:
@@ -178,9 +239,11 @@ class SvgTree:
 
     def setRadius(self, radius):
         self.discreteMap.setRadius(int(radius*self.pixel_per_mm))
+        self.pathCache.clear()
 
     def setScale(self, pixel_per_mm):
         self.pixel_per_mm = pixel_per_mm
+        self.pathCache.clear()
 
         svgNode = self.tree.xpath("//n:svg", namespaces={'n': NS['svg']})[0]
         svgNode.set('pixel_per_mm', str(pixel_per_mm))
@@ -199,64 +262,131 @@ class SvgTree:
         True if there's an obstacle in (x, y), false otherwise
         """
         point = Point(x, y)
-        isObst = False
-        id = 0
 
-        while not isObst and id<len(self.shapes):
-            if self.shapes[id] != self.rect:
-                isObst = point.containedIn(self.shapes[id])
-            id += 1
+        for shape in self.index.shapesAt(point.x, point.y):
+            if point.containedIn(shape):
+                return True
+
+        return False
+
+    def areObstacles(self, xs, ys):
+        """ Vectorized isObstacle (xs and ys are broadcast together) """
+        return self.index.containsPoints(xs, ys)
 
-        return isObst
+    def rasterize(self, xs, ys):
+        """ Occupancy grid of the points (xs[j], ys[i]) : True where there's an obstacle.
+        xs and ys must be sorted. Each shape only evaluates the points around its bounding rectangle. """
+        occupancy = np.zeros((len(ys), len(xs)), dtype=bool)
+
+        for shape in self.shapes:
+            if shape is self.rect:
+                continue
+
+            rect = shape.boundingRect
+            i0, i1 = np.searchsorted(xs, [rect.origin.x - 1, rect.origin.x + rect.width + 1], side='right')
+            j0, j1 = np.searchsorted(ys, [rect.origin.y - 1, rect.origin.y + rect.height + 1], side='right')
+
+            if i0 < i1 and j0 < j1:
+                occupancy[j0:j1, i0:i1] |= shape.containsPoints(xs[None, i0:i1], ys[j0:j1, None])
+
+        return occupancy
 
     def isReachable(self, x, y):
         """ True if (x, y) is reachable (not an obstacle and not too close to one)
         Uses the discrete map. (Don't call before the discrete map is initialized)"""
+        div = self.discreteMap.division
+        ax, ay = int(x/div), int(y/div)
+
         if not 0 <= x < self.width or not 0 <= y < self.height:
             return False
+        elif not ax < self.discreteMap.width or not ay < self.discreteMap.height:
+            # The map's size isn't always a multiple of the cells' size
+            return False
         else:
-            div = self.discreteMap.division
-            ax, ay = int(x/div), int(y/div)
-            return self.discreteMap.grid[ay][ax].reachable
+            return bool(self.discreteMap.grid[ay, ax])
 
     def rayDistance(self, x, y, angle):
         """ Returns distance to the closest obstacle in **mm** """
-        ray = Ray(x, y, angle - radians(self.north_angle) + pi/2)
-        dist = None
-
-        for shape in self.shapes:
-            intersections = ray.intersection(shape)
-
-            if len(intersections) > 0:
-                closestIntersect = min(intersect.distance(ray.origin) for intersect in intersections)
+        dist = self.rayDistances(x, y, angle)[0]
 
-                if dist is None:
-                    dist = closestIntersect
-                else:
-                    dist = min(dist, closestIntersect)
-
-        if dist is not None:
-            return dist/self.pixel_per_mm
+        if np.isfinite(dist):
+            return float(dist)
         else:
             return None
 
-    def search(self, begin, goal):
+    def rayDistances(self, xs, ys, angles):
+        """ Casts one ray per (x, y, angle) at once (NumPy arrays or scalars, which are broadcast)
+        Returns an array of distances to the closest obstacle in **mm** (inf if there's none) """
+        xs, ys, angles = np.broadcast_arrays(np.atleast_1d(np.asarray(xs, dtype=float)),
+                                             np.asarray(ys, dtype=float), np.asarray(angles, dtype=float))
+
+        rayAngles = angles - radians(self.north_angle) + pi/2
+        dist = self.index.castRays(xs.ravel(), ys.ravel(), np.cos(rayAngles).ravel(), -np.sin(rayAngles).ravel())
+
+        return dist.reshape(xs.shape) / self.pixel_per_mm
+
+    def expectedDistances(self, xs, ys, angles):
+        """ Same as rayDistances, but reads the distances from the precomputed table when there's one """
+        if self.rayTable is None:
+            return self.rayDistances(xs, ys, angles)
+
+        xs, ys, angles = np.broadcast_arrays(np.atleast_1d(np.asarray(xs, dtype=float)),
+                                             np.asarray(ys, dtype=float), np.asarray(angles, dtype=float))
+        rayAngles = angles - radians(self.north_angle) + pi/2
+
+        return self.rayTable.lookup(xs, ys, rayAngles) / self.pixel_per_mm
+
+    def loadRayTable(self, division=RayTable.def_division, bins=RayTable.def_bins):
+        """ Prepares the ray table (see prepareRayTable), and uses it from now on """
+        self.rayTable = self.prepareRayTable(division, bins)
+        return self.rayTable
+
+    def prepareRayTable(self, division=RayTable.def_division, bins=RayTable.def_bins):
+        """ Loads the ray table saved next to the svg file, or builds (and saves) it if there's none
+        (or if it was computed for other shapes or another resolution). The map isn't changed : it can be
+        done in another thread. If it can't be saved, the table is still returned (see RayTable.saveError). """
+        table = RayTable(self, division, bins)
+        path = RayTable.filePath(self.path)
+
+        if not table.load(path):
+            print "[ * ] Building the ray table ({}x{} cells, {} headings)...".format(table.width, table.height, bins)
+            table.build(self)
+            try:
+                table.save(path)
+            except (IOError, OSError) as e:
+                # (A read-only directory, or a map from Qt's resources) : the table is only kept in memory
+                print "[ ! ] Couldn't save the ray table : {}".format(e)
+                table.saveError = e
+
+        return table
+
+    def search(self, begin, goal, algorithm=None):
         div = self.discreteMap.division
         beginCell = Cell(begin[0] / div, begin[1] / div)
         goalCell = Cell(goal[0] / div, goal[1] / div)
 
-        path = self.discreteMap.search(beginCell, goalCell)
-        points = []
-        if path:
-            for cell in path:
-                points.append(Point(cell.x * div, cell.y * div))
+        if algorithm is None:
+            algorithm = self.discreteMap.algorithm
 
-        return points
+        key = (beginCell.x, beginCell.y, goalCell.x, goalCell.y, self.discreteMap.radius,
+               self.discreteMap.version, algorithm)
+        points = self.pathCache.get(key)
+
+        if points is None:
+            path = self.discreteMap.search(beginCell, goalCell, algorithm)
+            points = []
+            if path:
+                for cell in path:
+                    points.append(Point(cell.x * div, cell.y * div))
+
+            self.pathCache.put(key, points)
+
+        return list(points)
 
     def __str__(self):
         result = 'SVG Tree - "{}"\n'.format(self.title)
-        result += "Width : {}{} | Height : {}{} \n".format(self.width, self.width_unit,
-                  self.height, self.height_unit)
+        result += "Width : {}{} | Height : {}{} \n".format(self.width, self.unit,
+                  self.height, self.unit)
         result += '#'*40 + '\n'*2
         for shape in self.shapes:
             result += shape.__str__() + '\n'
@@ -265,8 +395,11 @@ class SvgTree:
 
 
 if __name__=="__main__":
+    # Usage : python svg.py [map.svg]
+    import sys
 
-    mySvg = SvgTree("maps/laby.svg")
+    mySvg = SvgTree(sys.argv[1] if len(sys.argv) > 1 else "maps/map2.svg", radius=0)
     print mySvg
     print ""
     path = mySvg.discreteMap.search(Cell(0, 0), Cell(40, 40))
+    print "Path from (0, 0) to (40, 40) : {} cells".format(len(path))
@@ -0,0 +1,135 @@
+# -*- coding: utf8 -*-
+
+"""
+    test_localization.py - the sharded particle filter against the serial one, and the vectorized
+    ray casting against a brute force one
+
+    Usage : python -m unittest discover tests (from the repository's root)
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from math import sqrt, cos, sin, radians, pi
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from svg import SvgTree
+from probability import ParticleFilter
+from parallel import ShardedParticleFilter
+from replay import ReplayCar
+from benchmark import syntheticMap
+
+mapsDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'maps')
+
+
+def bruteForceDistance(svgMap, x, y, angle):
+    """ Distance (in mm) along a ray cast from (x, y), checking every segment and ellipse of the map """
+    rayAngle = angle - radians(svgMap.north_angle) + pi/2
+    dx, dy = cos(rayAngle), -sin(rayAngle)
+    closest = float('inf')
+
+    for x1, y1, x2, y2 in svgMap.segments:
+        # (x, y) + t*(dx, dy) = (x1, y1) + u*(x2 - x1, y2 - y1)
+        ex, ey = x2 - x1, y2 - y1
+        denom = dx*ey - dy*ex
+        if denom == 0:
+            continue
+        t = ((x1 - x)*ey - (y1 - y)*ex) / denom
+        u = ((x1 - x)*dy - (y1 - y)*dx) / denom
+        if t >= 0 and 0 <= u <= 1:
+            closest = min(closest, t)
+
+    for cx, cy, rx, ry in svgMap.ellipses:
+        px, py, qx, qy = (x - cx) / rx, (y - cy) / ry, dx / rx, dy / ry
+        a, b, c = qx**2 + qy**2, 2*(px*qx + py*qy), px**2 + py**2 - 1
+        delta = b**2 - 4*a*c
+        if delta < 0:
+            continue
+        for t in sorted([(-b - sqrt(delta)) / (2*a), (-b + sqrt(delta)) / (2*a)]):
+            if t >= 0:
+                closest = min(closest, t)
+                break
+
+    return closest / svgMap.pixel_per_mm
+
+
+class RayDistancesTest(unittest.TestCase):
+
+    def testBruteForce(self):
+        # (The example map has rectangles, polylines and an ellipse)
+        svgMap = SvgTree(os.path.join(mapsDirectory, 'mapexample.svg'), ReplayCar.def_length)
+        svgMap.setScale(1.5)
+        svgMap.setNorthAngle(20.)
+
+        rand = np.random.RandomState(0)
+        xs = rand.uniform(0, svgMap.width, 500)
+        ys = rand.uniform(0, svgMap.height, 500)
+        angles = rand.uniform(-pi, pi, 500)
+
+        # From inside an obstacle, which of its borders is hit first depends on rounding
+        outside = ~svgMap.areObstacles(xs, ys)
+        self.assertGreater(outside.sum(), 250)
+        xs, ys, angles = xs[outside], ys[outside], angles[outside]
+
+        distances = svgMap.rayDistances(xs, ys, angles)
+        expected = np.array([bruteForceDistance(svgMap, x, y, angle) for x, y, angle in zip(xs, ys, angles)])
+
+        # (The bounding rectangle stops every ray)
+        self.assertTrue(np.isfinite(expected).all())
+        np.testing.assert_allclose(distances, expected, rtol=1e-9, atol=1e-6)
+
+
+class ShardedFilterTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        path = os.path.join(cls.directory, 'map.svg')
+        syntheticMap(path, 400, 300, 25)
+        cls.svgMap = SvgTree(path, ReplayCar.def_length)
+        cls.svgMap.setNorthAngle(30.)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        np.random.seed(0)
+        self.car = ReplayCar(self.svgMap, 200., 150., 0.3)
+        # Without displacement noise, moves are deterministic (the shards draw their own noise)
+        self.car.displacement_noise = 0.
+
+        self.serial = ParticleFilter(self.car, self.svgMap, n=3000, mode=ParticleFilter.markov)
+        self.sharded = ShardedParticleFilter(self.car, self.svgMap, processes=2, n=3000, mode=ParticleFilter.markov)
+        for name in ShardedParticleFilter.names:
+            setattr(self.sharded, name, getattr(self.serial, name).copy())
+
+    def tearDown(self):
+        self.sharded.close()
+
+    def assertSameParticles(self):
+        for name in ShardedParticleFilter.names:
+            np.testing.assert_allclose(getattr(self.sharded, name), getattr(self.serial, name), rtol=1e-12)
+
+    def testSenseScan(self):
+        readings = self.car.scan()
+        for particleFilter in [self.serial, self.sharded]:
+            particleFilter.senseScan(readings, self.car.angle)
+            # (A second one, as Markov updates add up)
+            particleFilter.senseScan(readings, self.car.angle)
+        self.assertSameParticles()
+
+    def testMove(self):
+        for particleFilter in [self.serial, self.sharded]:
+            particleFilter.move(35.)
+            particleFilter.senseScan(self.car.scan(), self.car.angle)
+        self.assertSameParticles()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,498 @@
+# -*- coding: utf8 -*-
+
+"""
+    test_particles.py - the particle filter's steps on small hand-built cases
+
+    Usage : python -m unittest discover tests (from the repository's root)
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from math import pi, sqrt
+
+import numpy as np
+import scipy.stats
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from astar import Cell
+from svg import SvgTree
+from probability import ParticleFilter, ExtendedKalmanFilter, logSumExp
+from replay import ReplayCar
+
+# A 600x400 map (1 pixel per mm), split in two by a wall from its top to its bottom
+def_map = ('<svg xmlns="http://www.w3.org/2000/svg" width="600px" height="400px" pixel_per_mm="1.0" north_angle="0.0">\n'
+           '<rect x="290" y="0" width="20" height="400"/>\n'
+           '</svg>\n')
+
+
+class FilterTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'map.svg')
+            with open(path, 'w') as svgFile:
+                svgFile.write(def_map)
+            cls.svgMap = SvgTree(path, ReplayCar.def_length)
+        finally:
+            shutil.rmtree(directory)
+
+    def setUp(self):
+        np.random.seed(0)
+        self.car = ReplayCar(self.svgMap, 100., 200., 0.)
+
+    def particleFilter(self, weights, **kwargs):
+        """ A filter whose particles are numbered (xs : 0, 1, ...) and have the given weights """
+        particleFilter = ParticleFilter(self.car, self.svgMap, n=len(weights), **kwargs)
+        particleFilter.xs = np.arange(len(weights), dtype=float)
+        particleFilter.ys = np.ones(len(weights)) * 200.
+        particleFilter.angles = np.zeros(len(weights))
+        with np.errstate(divide='ignore'):
+            particleFilter.logWeights = np.log(np.array(weights, dtype=float))
+        return particleFilter
+
+    # Clusters of 25 particles on a 5x5 grid (10 pixels apart) : their covariance is diag(200, 200)
+    grid = np.array([(dx, dy) for dx in xrange(-20, 21, 10) for dy in xrange(-20, 21, 10)], dtype=float)
+
+    def clusters(self, centers, weights, angles=None):
+        """ A filter with a cluster around each center, weighted as given (in all) """
+        particleFilter = self.particleFilter(np.ones(25 * len(centers)))
+        particleFilter.xs = np.concatenate([x + self.grid[:, 0] for x, y in centers])
+        particleFilter.ys = np.concatenate([y + self.grid[:, 1] for x, y in centers])
+        particleFilter.angles = np.zeros(25 * len(centers)) if angles is None else np.array(angles, dtype=float)
+        particleFilter.logWeights = np.log(np.repeat(weights, 25))
+        particleFilter.normalize()
+        return particleFilter
+
+
+class ResamplingTest(FilterTestCase):
+
+    def counts(self, particleFilter, n):
+        indexes = particleFilter.resampleIndexes(n)
+        self.assertEqual(len(indexes), n)
+        return np.bincount(indexes, minlength=len(particleFilter.xs))
+
+    def testSystematic(self):
+        """ Each particle is drawn floor(n*w) or ceil(n*w) times, whatever the random offset """
+        weights = np.array([0.45, 0.35, 0.2, 0.])
+        particleFilter = self.particleFilter(weights, resampling=ParticleFilter.systematic)
+        for seed in xrange(20):
+            np.random.seed(seed)
+            counts = self.counts(particleFilter, 10)
+            self.assertTrue((counts >= np.floor(10 * weights)).all() and (counts <= np.ceil(10 * weights)).all())
+
+        np.testing.assert_array_equal(self.counts(particleFilter, 20), [9, 7, 4, 0])
+
+    def testStratified(self):
+        particleFilter = self.particleFilter([0.45, 0.35, 0.2, 0.], resampling=ParticleFilter.stratified)
+        for seed in xrange(20):
+            np.random.seed(seed)
+            indexes = particleFilter.resampleIndexes(10)
+            # One draw per stratum : in the cumulated weights' order, each particle at most ceil(n*w) + 1 times
+            self.assertTrue((np.diff(indexes) >= 0).all())
+            self.assertTrue((np.bincount(indexes, minlength=4) <= np.ceil(10 * particleFilter.weights) + 1).all())
+            self.assertNotIn(3, indexes)
+
+    def testNullWeights(self):
+        for resampling in [ParticleFilter.multinomial, ParticleFilter.systematic, ParticleFilter.stratified]:
+            particleFilter = self.particleFilter([0., 1., 0., 0., 1.], resampling=resampling)
+            self.assertEqual(set(particleFilter.resampleIndexes(50)), set([1, 4]))
+
+            # All null : any particle will do
+            particleFilter = self.particleFilter([0., 0., 0.], resampling=resampling)
+            indexes = particleFilter.resampleIndexes(50)
+            self.assertTrue(((indexes >= 0) & (indexes < 3)).all())
+
+    def testResample(self):
+        """ The resampled particles are copies of the drawn ones, equally weighted """
+        particleFilter = self.particleFilter([0.75, 0.25, 0., 0., 0., 0., 0., 0.], resampling=ParticleFilter.systematic)
+        self.assertTrue(particleFilter.resample())
+
+        np.testing.assert_array_equal(np.sort(particleFilter.xs), [0.]*6 + [1.]*2)
+        np.testing.assert_allclose(particleFilter.weights, np.ones(8) / 8)
+
+
+class KldSamplingTest(FilterTestCase):
+
+    def cloud(self, bins, n):
+        """ A filter with n particles spread over 'bins' bins (of the KLD-sampling's size, in turn) """
+        particleFilter = self.particleFilter(np.ones(n))
+        binSize = particleFilter.binSize * self.svgMap.pixel_per_mm
+        cells = np.arange(n) % bins
+        particleFilter.xs = (cells % 10 + 0.5) * binSize
+        particleFilter.ys = (cells / 10 + 0.5) * binSize
+        return particleFilter
+
+    def testSingleBin(self):
+        particleFilter = self.cloud(1, 1000)
+        self.assertEqual(particleFilter.kldCount(np.arange(1000)), particleFilter.nMin)
+
+    def testBound(self):
+        """ With k bins, the bound is the chi-square quantile (k - 1 degrees of freedom) over 2*error """
+        for bins in [20, 40, 60]:
+            particleFilter = self.cloud(bins, 5000)
+            expected = scipy.stats.chi2.ppf(0.99, bins - 1) / (2 * particleFilter.kldError)
+            self.assertGreater(expected, particleFilter.nMin)
+            self.assertAlmostEqual(particleFilter.kldCount(np.arange(5000)) / expected, 1., delta=0.01)
+
+        # Not enough particles for the bound : all of them
+        self.assertEqual(self.cloud(60, 500).kldCount(np.arange(500)), 500)
+
+        # Headings count too
+        particleFilter = self.cloud(20, 5000)
+        particleFilter.angles = (np.arange(5000) / 20 % 2) * 2 * particleFilter.binAngle
+        expected = scipy.stats.chi2.ppf(0.99, 39) / (2 * particleFilter.kldError)
+        self.assertAlmostEqual(particleFilter.kldCount(np.arange(5000)) / expected, 1., delta=0.01)
+
+    def testAdaptiveResample(self):
+        """ A converged cloud needs the fewest particles """
+        particleFilter = self.particleFilter([1.] + [0.]*999, adaptive=True)
+        particleFilter.resample()
+        self.assertEqual(particleFilter.N, particleFilter.nMin)
+        self.assertEqual(len(particleFilter.xs), particleFilter.nMin)
+
+
+class EffectiveSampleSizeTest(FilterTestCase):
+
+    def testSize(self):
+        self.assertAlmostEqual(self.particleFilter(np.ones(10)).effectiveSampleSize(), 10.)
+        self.assertAlmostEqual(self.particleFilter([0.5, 0.5, 0., 0.]).effectiveSampleSize(), 2.)
+        self.assertAlmostEqual(self.particleFilter([1., 0., 0., 0.]).effectiveSampleSize(), 1.)
+        # (Unnormalized weights give the same)
+        self.assertAlmostEqual(self.particleFilter([3., 1.]).effectiveSampleSize(), 16. / 10)
+        self.assertEqual(self.particleFilter([0., 0.]).effectiveSampleSize(), 0.)
+
+    def testSkip(self):
+        """ In markov mode, the particles are only resampled when the effective sample size drops below
+        essThreshold * N (and they then keep their weights, normalized) """
+        weights = [1.]*6 + [0.5]*4
+        particleFilter = self.particleFilter(weights, mode=ParticleFilter.markov)
+        self.assertGreaterEqual(particleFilter.effectiveSampleSize(), particleFilter.essThreshold * 10)
+
+        self.assertFalse(particleFilter.resample())
+        self.assertEqual((particleFilter.stats['skipped'], particleFilter.stats['resampled']), (1, 0))
+        np.testing.assert_array_equal(particleFilter.xs, np.arange(10))
+        np.testing.assert_allclose(particleFilter.weights, np.array(weights) / sum(weights))
+        self.assertAlmostEqual(np.exp(particleFilter.logWeights).sum(), 1.)
+
+        # Forced anyway
+        self.assertTrue(particleFilter.resample(force=True))
+        self.assertEqual(particleFilter.stats['resampled'], 1)
+
+        # Below the threshold
+        particleFilter = self.particleFilter([1.]*4 + [0.]*6, mode=ParticleFilter.markov)
+        self.assertTrue(particleFilter.resample())
+        self.assertEqual(set(particleFilter.xs), set([0., 1., 2., 3.]))
+
+    def testSimpleMode(self):
+        """ In simple mode, the weights don't accumulate : the particles are always resampled """
+        particleFilter = self.particleFilter(np.ones(10), mode=ParticleFilter.simple)
+        self.assertTrue(particleFilter.resample())
+        self.assertEqual(particleFilter.stats['skipped'], 0)
+
+
+class LogWeightsTest(FilterTestCase):
+
+    def testLogSumExp(self):
+        self.assertAlmostEqual(logSumExp(np.log([1., 2., 3.])), np.log(6.))
+        # Far beyond exp's range, both ways
+        self.assertAlmostEqual(logSumExp(np.array([-2000., -2000.])), -2000. + np.log(2.))
+        self.assertAlmostEqual(logSumExp(np.array([1000., 1000. + np.log(3.)])), 1000. + np.log(4.))
+        self.assertEqual(logSumExp(np.array([-np.inf, -np.inf])), -np.inf)
+        self.assertEqual(logSumExp(np.empty(0)), -np.inf)
+
+    def testNormalize(self):
+        """ Weights whose exponentials underflow keep their ratios """
+        particleFilter = self.particleFilter(np.ones(3))
+        particleFilter.logWeights = np.array([-1500., -1500. + np.log(2.), -1500. + np.log(5.)])
+        particleFilter.normalize()
+        np.testing.assert_allclose(np.exp(particleFilter.logWeights), [0.125, 0.25, 0.625])
+        np.testing.assert_allclose(particleFilter.weights, [0.125, 0.25, 0.625])
+
+        # Nothing to normalize : unchanged
+        particleFilter.logWeights = np.array([-np.inf, -np.inf])
+        particleFilter.normalize()
+        np.testing.assert_array_equal(particleFilter.logWeights, [-np.inf, -np.inf])
+        np.testing.assert_array_equal(particleFilter.weights, [0., 0.])
+
+    def testMarkovUpdates(self):
+        """ Many sweeps add up (as logarithms) without the weights vanishing : here, the ratio of the two
+        particles' weights is far below the smallest float """
+        self.car.sensor_noise = 10.
+        readings = [(0, 150.)] * 8
+
+        particleFilter = self.particleFilter(np.ones(2), mode=ParticleFilter.markov)
+        # (Rays cast upwards : 201 and 161 mm from the map's top)
+        particleFilter.ys = np.array([200., 160.])
+        for i in xrange(20):
+            particleFilter.senseScan(readings, 0.)
+            particleFilter.normalize()
+        self.assertTrue(np.isfinite(particleFilter.logWeights).all())
+        self.assertLess(particleFilter.logWeights[0] - particleFilter.logWeights[1], np.log(np.finfo(float).tiny))
+
+        # The same two particles, sensing once : the ratio of their likelihoods, raised to the 20th power
+        once = self.particleFilter(np.ones(2), mode=ParticleFilter.simple)
+        once.ys = np.array([200., 160.])
+        once.senseScan(readings, 0.)
+        np.testing.assert_allclose(np.diff(particleFilter.logWeights), 20 * np.diff(once.logWeights))
+
+class FreeSpaceTest(FilterTestCase):
+    """ On the 120x80 cells' grid (5 pixels per cell), the wall covers the columns 58 to 61. With the car's
+    100 mm, the cells closer than 10 cells to it are out of reach : the columns 48 to 71. """
+
+    def setUp(self):
+        FilterTestCase.setUp(self)
+        self.discreteMap = self.svgMap.discreteMap
+        self.discreteMap.setRadius(ReplayCar.def_length)
+        self.assertEqual((self.discreteMap.width, self.discreteMap.height), (120, 80))
+
+    def tearDown(self):
+        self.discreteMap.setRadius(ReplayCar.def_length)
+
+    def columns(self, cells):
+        return set(np.asarray(cells) % self.discreteMap.width)
+
+    def testFreeCells(self):
+        discreteMap = self.discreteMap
+        self.assertEqual(self.columns(discreteMap.freeCells()), set(range(120)) - set(range(58, 62)))
+        self.assertEqual(len(discreteMap.freeCells()), 116 * 80)
+        self.assertEqual(self.columns(discreteMap.freeCells(True)), set(range(48)) | set(range(72, 120)))
+        self.assertEqual(len(discreteMap.freeCells(True)), 96 * 80)
+
+    def testAround(self):
+        discreteMap = self.discreteMap
+        self.assertEqual(self.columns(discreteMap.freeCells(True, Cell(10, 10))), set(range(48)))
+        self.assertEqual(self.columns(discreteMap.freeCells(False, Cell(100, 70))), set(range(62, 120)))
+        self.assertEqual(len(discreteMap.freeCells(False, Cell(100, 70))), 58 * 80)
+
+        # Out of the free space, or of the map : nothing
+        self.assertEqual(len(discreteMap.freeCells(False, Cell(60, 10))), 0)
+        self.assertEqual(len(discreteMap.freeCells(True, Cell(50, 10))), 0)
+        self.assertEqual(len(discreteMap.freeCells(True, Cell(-1, 10))), 0)
+
+    def testVersions(self):
+        """ The index follows the grid's changes """
+        discreteMap = self.discreteMap
+        discreteMap.setRadius(2 * ReplayCar.def_length)
+        self.assertEqual(self.columns(discreteMap.freeCells(True)), set(range(38)) | set(range(82, 120)))
+        discreteMap.setReachable([Cell(x, 0) for x in xrange(120)], False)
+        self.assertEqual(len(discreteMap.freeCells(True)), 76 * 79)
+
+    def testSpawning(self):
+        particleFilter = ParticleFilter(self.car, self.svgMap, n=2000)
+        self.assertTrue((particleFilter.xs < 290).any() and (particleFilter.xs >= 310).any())
+        self.assertFalse(self.svgMap.areObstacles(particleFilter.xs, particleFilter.ys).any())
+
+        # Where the car fits, on its side of the wall
+        particleFilter.spawnReachable = True
+        particleFilter.spawnAround = (100., 200.)
+        xs, ys = particleFilter.randomPositions(2000)
+        self.assertTrue(((xs >= 0) & (xs < 48 * 5)).all())
+        self.assertTrue(((ys >= 0) & (ys < 400)).all())
+
+        # From the wall : anywhere the car fits
+        particleFilter.spawnAround = (300., 200.)
+        xs, ys = particleFilter.randomPositions(2000)
+        self.assertTrue((xs < 48 * 5).any() and (xs >= 72 * 5).any())
+        self.assertFalse(((xs >= 48 * 5) & (xs < 72 * 5)).any())
+
+
+class PosesTest(FilterTestCase):
+
+    def testTwoClusters(self):
+        particleFilter = self.clusters([(150., 250.), (450., 150.)], [0.7, 0.3])
+        hypotheses = particleFilter.estimatePoses(particleFilter.weights)
+
+        self.assertEqual(len(hypotheses), 2)
+        for hypothesis, (x, y, weight) in zip(hypotheses, [(150., 250., 0.7), (450., 150., 0.3)]):
+            self.assertAlmostEqual(hypothesis.x, x)
+            self.assertAlmostEqual(hypothesis.y, y)
+            self.assertAlmostEqual(hypothesis.weight, weight)
+            np.testing.assert_allclose(hypothesis.covariance, [[200., 0.], [0., 200.]], atol=1e-6)
+
+        # The barycenter is the best hypothesis (not the middle of the two clusters)
+        particleFilter.check_relevance()
+        self.assertAlmostEqual(particleFilter.barycenter.x, 150.)
+        self.assertAlmostEqual(particleFilter.barycenter.y, 250.)
+
+    def testHeadings(self):
+        """ The headings' mean is circular : around pi, -3.1 and 3.1 don't average to 0 """
+        angles = np.tile([pi - 0.1, -pi + 0.1, pi - 0.2, -pi + 0.2, pi], 5)
+        hypothesis = self.clusters([(150., 250.)], [1.], angles).estimatePoses(np.ones(25) / 25)[0]
+        self.assertAlmostEqual(abs(hypothesis.angle), pi, places=5)
+
+    def testCorrelation(self):
+        particleFilter = self.clusters([(150., 250.)], [1.])
+        particleFilter.ys = 250. - (particleFilter.xs - 150.)
+        covariance = particleFilter.estimatePoses(particleFilter.weights)[0].covariance
+        np.testing.assert_allclose(covariance, [[200., -200.], [-200., 200.]], atol=1e-6)
+
+    def testLimits(self):
+        # At most k hypotheses, the heaviest
+        centers = [(50., 50.), (350., 50.), (50., 350.), (350., 350.), (550., 250.)]
+        weights = [0.1, 0.3, 0.15, 0.25, 0.2]
+        hypotheses = self.clusters(centers, weights).estimatePoses(np.repeat(weights, 25))
+        self.assertEqual(len(hypotheses), 3)
+        np.testing.assert_allclose([(h.x, h.y, h.weight) for h in hypotheses],
+                                   [(350., 50., 0.3), (350., 350., 0.25), (550., 250., 0.2)])
+
+        # Particles more than two bins away from a seed are in no hypothesis
+        particleFilter = self.clusters([(150., 250.), (450., 150.)], [0.7, 0.3])
+        particleFilter.k = 1
+        hypotheses = particleFilter.estimatePoses(particleFilter.weights)
+        self.assertEqual(len(hypotheses), 1)
+        self.assertAlmostEqual(hypotheses[0].weight, 0.7)
+
+    def testRelevance(self):
+        """ 1 - the mean distance to the best pose (for a Gaussian cloud : sqrt(pi)/2 times the root mean square)
+        over the car's length """
+        particleFilter = self.clusters([(150., 250.)], [1.])
+        particleFilter.check_relevance()
+        self.assertAlmostEqual(particleFilter.relevance, 1. - sqrt(pi * 400.) / 2 / ReplayCar.def_length)
+
+        particleFilter.xs, particleFilter.ys = np.ones(25) * 150., np.ones(25) * 250.
+        particleFilter.check_relevance()
+        self.assertAlmostEqual(particleFilter.relevance, 1.)
+
+        # Two clusters : far from localized
+        particleFilter = self.clusters([(150., 250.), (450., 150.)], [0.5, 0.5])
+        particleFilter.check_relevance()
+        self.assertEqual(particleFilter.relevance, 0.)
+
+
+class KalmanFilterTest(FilterTestCase):
+    """ Upwards (heading 0, north 0), the expected distance is y + 1 mm (the map's border is at y = -1) :
+    a linear measurement, for which the Kalman filter's update is exact """
+
+    def setUp(self):
+        FilterTestCase.setUp(self)
+        self.car.sensor_noise = 30.
+        self.ekf = ExtendedKalmanFilter(self.car, self.svgMap, 100., 200., np.diag([400., 900.]), 0.)
+
+    def testPredict(self):
+        """ The displacement's noise grows the covariance along the heading, the heading's noise across it """
+        self.ekf.predict(50.)
+        np.testing.assert_allclose(self.ekf.mean, [100., 150.])
+        np.testing.assert_allclose(self.ekf.covariance, np.diag([400. + (50. * np.radians(2.))**2, 900. + 5.**2]))
+
+        # Heading to the left (-x)
+        self.ekf.covariance = np.zeros((2, 2))
+        self.ekf.setAngle(pi / 2)
+        self.ekf.predict(50.)
+        np.testing.assert_allclose(self.ekf.mean, [50., 150.], atol=1e-9)
+        np.testing.assert_allclose(self.ekf.covariance, np.diag([5.**2, (50. * np.radians(2.))**2]), atol=1e-9)
+
+    def testUpdate(self):
+        # A single beam : prior variance 900 and noise 900 (30²) halve the variance and the innovation
+        self.assertTrue(self.ekf.update(np.array([0.]), np.array([190.]), 0.))
+        np.testing.assert_allclose(self.ekf.mean, [100., 200. - 5.5], atol=1e-9)
+        np.testing.assert_allclose(self.ekf.covariance, np.diag([400., 450.]), atol=1e-9)
+
+        # Two more beams : the variance becomes 1 / (1/450 + 2/900)
+        self.assertTrue(self.ekf.update(np.array([0., 0.]), np.array([190., 190.]), 0.))
+        np.testing.assert_allclose(self.ekf.covariance, np.diag([400., 225.]), atol=1e-9)
+        np.testing.assert_allclose(self.ekf.mean, [100., 194.5 - 225. / 900. * 2 * 5.5], atol=1e-9)
+
+    def testNothingHit(self):
+        self.assertTrue(self.ekf.update(np.array([0.]), np.array([self.svgMap.width + self.svgMap.height]), 0.))
+        np.testing.assert_array_equal(self.ekf.mean, [100., 200.])
+
+    def testGate(self):
+        """ Normalized innovations beyond the chi-square's 99% quantile (6.6 for a beam) are rejected ; after
+        maxFailures of them in a row, the filter is lost """
+        S = 900. + 900.
+        self.assertTrue(self.ekf.update(np.array([0.]), np.array([201. - sqrt(5. * S)]), 0.))
+
+        self.ekf = ExtendedKalmanFilter(self.car, self.svgMap, 100., 200., np.diag([400., 900.]), 0.)
+        for i in xrange(ExtendedKalmanFilter.def_maxFailures):
+            self.assertFalse(self.ekf.lost)
+            self.assertFalse(self.ekf.update(np.array([0.]), np.array([201. - sqrt(8. * S)]), 0.))
+            np.testing.assert_array_equal(self.ekf.mean, [100., 200.])
+        self.assertTrue(self.ekf.lost)
+
+        # An accepted sweep resets the count
+        self.ekf = ExtendedKalmanFilter(self.car, self.svgMap, 100., 200., np.diag([400., 900.]), 0.)
+        for reading in [201. - sqrt(8. * S), 201. - sqrt(8. * S), 201., 201. - sqrt(8. * S)]:
+            self.ekf.update(np.array([0.]), np.array([reading]), 0.)
+        self.assertEqual(self.ekf.failures, 1)
+
+
+class TrackingTest(FilterTestCase):
+
+    def converged(self, ys=None):
+        particleFilter = self.clusters([(150., 250.)], [1.])
+        particleFilter.tracking = True
+        particleFilter.mode = ParticleFilter.markov
+        if ys is not None:
+            particleFilter.ys = ys(particleFilter.xs)
+        particleFilter.check_relevance()
+        return particleFilter
+
+    def testStartTracking(self):
+        particleFilter = self.converged()
+        self.assertFalse(particleFilter.resample())
+
+        ekf = particleFilter.ekf
+        self.assertIsNotNone(ekf)
+        np.testing.assert_allclose(ekf.mean, [150., 250.])
+        # The cluster's covariance, widened by (car's length / 4)² / 2
+        np.testing.assert_allclose(ekf.covariance, np.diag([200., 200.]) + 312.5 * np.eye(2), atol=1e-9)
+
+        # The particles are dropped ; the pose is the Kalman filter's
+        self.assertEqual(len(particleFilter.xs), 0)
+        self.assertEqual(len(particleFilter.hypotheses), 1)
+        self.assertAlmostEqual(particleFilter.relevance, 1. - sqrt(2 * 512.5) / ReplayCar.def_length)
+
+    def testNegativeCorrelation(self):
+        """ The cluster's shape is kept, whichever way it's tilted """
+        for sign in [-1, 1]:
+            particleFilter = self.converged(lambda xs: 250. + sign * (xs - 150.))
+            particleFilter.startTracking()
+            np.testing.assert_allclose(particleFilter.ekf.covariance,
+                                       [[512.5, sign * 200.], [sign * 200., 512.5]], atol=1e-9)
+
+    def testIndefiniteCovariance(self):
+        particleFilter = self.converged()
+        particleFilter.hypotheses[0].covariance = np.array([[100., -120.], [-120., 100.]])
+        particleFilter.startTracking()
+
+        # Eigenvalues 220 and -20 (along the diagonals) : the negative one is clamped to 0
+        np.testing.assert_allclose(particleFilter.ekf.covariance, [[110., -110.], [-110., 110.]] + 312.5 * np.eye(2),
+                                   atol=1e-9)
+
+    def testNotConverged(self):
+        particleFilter = self.clusters([(150., 250.), (450., 150.)], [0.7, 0.3])
+        particleFilter.tracking = True
+        particleFilter.startTracking()
+        self.assertIsNone(particleFilter.ekf)
+
+        # Or not tracking at all
+        particleFilter = self.converged()
+        particleFilter.tracking = False
+        particleFilter.startTracking()
+        self.assertIsNone(particleFilter.ekf)
+
+    def testStopTracking(self):
+        """ Once lost, the particles are back : half of them around the last pose, the others anywhere """
+        particleFilter = self.converged()
+        particleFilter.startTracking()
+        particleFilter.ekf.lost = True
+
+        self.assertTrue(particleFilter.resample())
+        self.assertIsNone(particleFilter.ekf)
+        self.assertEqual(len(particleFilter.xs), particleFilter.N)
+        self.assertAlmostEqual(particleFilter.weights.sum(), 1.)
+
+        n = int(particleFilter.N * (1. - particleFilter.recovery))
+        distances = np.hypot(particleFilter.xs[:n] - 150., particleFilter.ys[:n] - 250.)
+        # (Their covariance : the Kalman filter's plus the car's length squared, about 150 pixels in each direction)
+        self.assertLess(np.median(distances), 300.)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,300 @@
+# -*- coding: utf8 -*-
+
+"""
+    test_pathfinding.py - the search engines' paths against a plain Dijkstra (scipy's) on the same grid
+
+    Usage : python -m unittest discover tests (from the repository's root)
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from math import sqrt
+
+import numpy as np
+import scipy.sparse.csgraph
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from astar import Cell, DiscreteMap, gridGraph
+from svg import SvgTree, PathCache
+from benchmark import syntheticMap, queries, pathLength
+
+# Small enough for Dijkstra to be run from every query's beginning
+def_size = (400, 300, 25)
+def_radius = 20
+def_queries = 40
+
+# HPA*'s paths go through the clusters' entrances : they are only close to optimal
+def_hpaSlack = 1.25
+
+
+class PathfindingTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        path = os.path.join(cls.directory, 'map.svg')
+        syntheticMap(path, *def_size)
+        cls.svgMap = SvgTree(path, def_radius)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.discreteMap = self.svgMap.discreteMap
+        self.discreteMap.setRadius(def_radius)
+
+    def dijkstra(self, begin):
+        """ Costs (in cells) from begin to every cell of the current grid (inf if unreachable) """
+        discreteMap = self.discreteMap
+        costs = scipy.sparse.csgraph.dijkstra(gridGraph(discreteMap.grid), indices=begin.y*discreteMap.width + begin.x)
+        return costs.reshape(discreteMap.grid.shape)
+
+    def assertWalkable(self, begin, path, goal, adjacent=True):
+        """ The path leads from begin to goal through walkable cells (adjacent ones, unless it's any-angle) """
+        self.assertEqual((path[-1].x, path[-1].y), (goal.x, goal.y))
+        previous = begin
+        for cell in path:
+            self.assertTrue(self.discreteMap.grid[cell.y, cell.x])
+            if adjacent:
+                self.assertLessEqual(max(abs(cell.x - previous.x), abs(cell.y - previous.y)), 1)
+            previous = cell
+
+    def checkOptimal(self, algorithm):
+        pairs = queries(self.discreteMap, def_queries, 0)
+        found = 0
+        for begin, goal in pairs:
+            cost = self.dijkstra(begin)[goal.y, goal.x]
+            path = self.discreteMap.search(begin, goal, algorithm)
+
+            if (begin.x, begin.y) == (goal.x, goal.y) or not np.isfinite(cost):
+                self.assertEqual(path, [])
+                continue
+
+            self.assertWalkable(begin, path, goal)
+            self.assertAlmostEqual(pathLength(begin, path), cost, places=6)
+            found += 1
+
+        # (Otherwise, the map would test nothing)
+        self.assertGreater(found, def_queries / 2)
+
+    def testAStar(self):
+        self.checkOptimal(DiscreteMap.astar)
+
+    def testJumpPointSearch(self):
+        self.checkOptimal(DiscreteMap.jps)
+
+    def testDStarLite(self):
+        self.checkOptimal(DiscreteMap.dstarlite)
+
+    def testFlowField(self):
+        self.checkOptimal(DiscreteMap.flowfield)
+
+    def testHierarchicalSearch(self):
+        for begin, goal in queries(self.discreteMap, def_queries, 0):
+            cost = self.dijkstra(begin)[goal.y, goal.x]
+            path = self.discreteMap.search(begin, goal, DiscreteMap.hpa)
+
+            if (begin.x, begin.y) == (goal.x, goal.y) or not np.isfinite(cost):
+                self.assertEqual(path, [])
+                continue
+
+            self.assertWalkable(begin, path, goal)
+            length = pathLength(begin, path)
+            self.assertGreaterEqual(length, cost - 1e-6)
+            self.assertLessEqual(length, def_hpaSlack * cost)
+
+    def testThetaStar(self):
+        engine = self.discreteMap.engines[DiscreteMap.thetastar]
+        for begin, goal in queries(self.discreteMap, def_queries, 0):
+            cost = self.dijkstra(begin)[goal.y, goal.x]
+            path = self.discreteMap.search(begin, goal, DiscreteMap.thetastar)
+
+            if (begin.x, begin.y) == (goal.x, goal.y) or not np.isfinite(cost):
+                self.assertEqual(path, [])
+                continue
+
+            # Straight lines between waypoints : never longer than the grid's paths, and never shorter than
+            # the straight line to the goal
+            self.assertWalkable(begin, path, goal, adjacent=False)
+            length = pathLength(begin, path)
+            self.assertLessEqual(length, cost + 1e-6)
+            self.assertGreaterEqual(length, sqrt((goal.x - begin.x)**2 + (goal.y - begin.y)**2) - 1e-6)
+
+            previous = begin
+            for cell in path:
+                self.assertTrue(engine.lineOfSight(engine.index(previous.x, previous.y), engine.index(cell.x, cell.y)))
+                previous = cell
+
+    def wallAcross(self, begin, path, goal):
+        """ The reachable cells of a square across the middle of a path (but its ends) """
+        middle = path[len(path) / 2]
+        return [Cell(x, y) for y in xrange(middle.y - 3, middle.y + 4) for x in xrange(middle.x - 3, middle.x + 4)
+                if 0 <= x < self.discreteMap.width and 0 <= y < self.discreteMap.height and
+                self.discreteMap.grid[y, x] and (x, y) not in [(begin.x, begin.y), (goal.x, goal.y)]]
+
+    def testDStarLiteAfterFlip(self):
+        """ D* Lite repairs its search when cells of its path are blocked (and freed again) """
+        discreteMap = self.discreteMap
+        flipped = 0
+        for begin, goal in queries(discreteMap, def_queries, 1):
+            path = discreteMap.search(begin, goal, DiscreteMap.dstarlite)
+            if len(path) < 10:
+                continue
+
+            wall = self.wallAcross(begin, path, goal)
+            for reachable in [False, True]:
+                discreteMap.setReachable(wall, reachable)
+
+                cost = self.dijkstra(begin)[goal.y, goal.x]
+                repaired = discreteMap.search(begin, goal, DiscreteMap.dstarlite)
+                fresh = discreteMap.search(begin, goal, DiscreteMap.astar)
+
+                if not np.isfinite(cost):
+                    self.assertEqual(repaired, [])
+                    self.assertEqual(fresh, [])
+                    continue
+
+                self.assertWalkable(begin, repaired, goal)
+                self.assertAlmostEqual(pathLength(begin, repaired), cost, places=6)
+                self.assertAlmostEqual(pathLength(begin, repaired), pathLength(begin, fresh), places=6)
+            flipped += 1
+
+        self.assertGreater(flipped, 0)
+
+    def testSetReachable(self):
+        """ The engines with a state of their own, and the caches, follow the blocked cells """
+        discreteMap = self.discreteMap
+        begin, goal = max(queries(discreteMap, def_queries, 1),
+                          key=lambda (begin, goal): len(discreteMap.search(begin, goal, DiscreteMap.astar)))
+        discreteMap.flowField(goal)
+        self.assertIn(goal.y*discreteMap.width + goal.x, discreteMap.freeCells(True, begin))
+
+        wall = self.wallAcross(begin, discreteMap.search(begin, goal, DiscreteMap.astar), goal)
+        version = discreteMap.version
+        discreteMap.setReachable(wall, False)
+        self.assertEqual(discreteMap.version, version + 1)
+        self.assertFalse(any(discreteMap.grid[cell.y, cell.x] for cell in wall))
+
+        # (Out of the grid : ignored)
+        discreteMap.setReachable([Cell(-1, 0), Cell(discreteMap.width, 0)], False)
+
+        blocked = set(cell.y*discreteMap.width + cell.x for cell in wall)
+        self.assertFalse(blocked & set(discreteMap.freeCells(True)))
+
+        cost = self.dijkstra(begin)[goal.y, goal.x]
+        for algorithm in [DiscreteMap.flowfield, DiscreteMap.thetastar]:
+            path = discreteMap.search(begin, goal, algorithm)
+            if not np.isfinite(cost):
+                self.assertEqual(path, [])
+                continue
+            self.assertFalse(blocked & set(cell.y*discreteMap.width + cell.x for cell in path))
+            if algorithm == DiscreteMap.flowfield:
+                self.assertAlmostEqual(pathLength(begin, path), cost, places=6)
+            else:
+                engine, previous = discreteMap.engines[algorithm], begin
+                for cell in path:
+                    self.assertTrue(engine.lineOfSight(engine.index(previous.x, previous.y),
+                                                       engine.index(cell.x, cell.y)))
+                    previous = cell
+
+    def testDStarLiteAfterRadius(self):
+        """ Same after a change of the car's size (which changes many cells at once) """
+        discreteMap = self.discreteMap
+        pairs = queries(discreteMap, def_queries, 2)
+        for begin, goal in pairs:
+            discreteMap.search(begin, goal, DiscreteMap.dstarlite)
+
+        discreteMap.setRadius(def_radius / 2)
+        for begin, goal in pairs:
+            cost = self.dijkstra(begin)[goal.y, goal.x]
+            path = discreteMap.search(begin, goal, DiscreteMap.dstarlite)
+            if (begin.x, begin.y) == (goal.x, goal.y) or not np.isfinite(cost):
+                self.assertEqual(path, [])
+                continue
+            self.assertAlmostEqual(pathLength(begin, path), cost, places=6)
+
+
+class OpenMapTest(unittest.TestCase):
+    """ Without obstacles, Theta* can skip most line of sight checks : not through a wall added meanwhile """
+
+    def testThetaStarAfterFlip(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'map.svg')
+            syntheticMap(path, 400, 300, 0)
+            discreteMap = SvgTree(path, def_radius).discreteMap
+        finally:
+            shutil.rmtree(directory)
+
+        begin, goal = Cell(10, 30), Cell(70, 30)
+        self.assertEqual(len(discreteMap.search(begin, goal, DiscreteMap.thetastar)), 1)
+
+        discreteMap.setReachable([Cell(40, y) for y in xrange(10, 51)], False)
+        path = discreteMap.search(begin, goal, DiscreteMap.thetastar)
+        self.assertGreater(len(path), 1)
+
+        engine, previous = discreteMap.engines[DiscreteMap.thetastar], begin
+        for cell in path:
+            self.assertTrue(engine.lineOfSight(engine.index(previous.x, previous.y), engine.index(cell.x, cell.y)))
+            previous = cell
+
+
+class PathCacheTest(unittest.TestCase):
+
+    def testLeastRecentlyUsed(self):
+        cache = PathCache(size=2)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', [1])
+        cache.put('b', [2])
+        self.assertEqual(cache.get('a'), [1])
+
+        # 'b' is now the least recently used one
+        cache.put('c', [3])
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), [1])
+        self.assertEqual(cache.get('c'), [3])
+        self.assertEqual((cache.hits, cache.misses), (3, 2))
+
+        cache.clear()
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual((cache.hits, cache.misses), (3, 3))
+
+    def testSearches(self):
+        """ The map's searches are cached per algorithm, until the grid changes """
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'map.svg')
+            syntheticMap(path, *def_size)
+            svgMap = SvgTree(path, def_radius)
+        finally:
+            shutil.rmtree(directory)
+
+        div = svgMap.discreteMap.division
+        begin, goal = [((cell.x + 0.5) * div, (cell.y + 0.5) * div)
+                       for cell in queries(svgMap.discreteMap, 1, 0)[0]]
+        cache = svgMap.pathCache
+
+        first = svgMap.search(begin, goal, DiscreteMap.astar)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.assertEqual(svgMap.search(begin, goal, DiscreteMap.astar), first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # (The returned list is a copy : changing it doesn't change the cache)
+        first.pop()
+        self.assertNotEqual(svgMap.search(begin, goal, DiscreteMap.astar), first)
+
+        svgMap.search(begin, goal, DiscreteMap.jps)
+        self.assertEqual(cache.misses, 2)
+
+        svgMap.setRadius(def_radius / 2)
+        svgMap.search(begin, goal, DiscreteMap.astar)
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
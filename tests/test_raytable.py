@@ -0,0 +1,114 @@
+# -*- coding: utf8 -*-
+
+"""
+    test_raytable.py - the precomputed ray distances : lookups, saving and loading
+
+    Usage : python -m unittest discover tests (from the repository's root)
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from math import pi
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from svg import SvgTree
+from raytable import RayTable
+from benchmark import syntheticMap
+
+# A coarse table, quick to build
+def_division = 10
+def_bins = 16
+
+
+class RayTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'map.svg')
+        syntheticMap(self.path, 300, 200, 15)
+        self.svgMap = SvgTree(self.path, 50)
+        self.svgMap.setNorthAngle(30.)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testLookup(self):
+        """ At the cells' centers and along the bins' headings, the table gives the cast distances """
+        table = RayTable(self.svgMap, def_division, def_bins)
+        table.build(self.svgMap)
+        self.assertEqual(table.memoryUsage(), table.width * table.height * def_bins * 4)
+
+        ys, xs, bins = np.mgrid[0:table.height, 0:table.width, 0:def_bins]
+        xs = (xs + 0.5) * def_division
+        ys = (ys + 0.5) * def_division
+        rayAngles = bins * 2*pi / def_bins
+
+        # (The map's angles are the car's : rayDistances turns them by the north angle)
+        angles = rayAngles + np.radians(self.svgMap.north_angle) - pi/2
+        expected = self.svgMap.rayDistances(xs, ys, angles) * self.svgMap.pixel_per_mm
+        # (Rounding the headings back and forth, a ray grazing a corner can miss it)
+        close = np.isclose(table.lookup(xs, ys, rayAngles), expected, rtol=1e-6)
+        self.assertLess((~close).sum(), 0.001 * close.size)
+
+        # Anywhere in a cell, and a little off a bin's heading, the values are the same
+        offset = 0.4 * def_division
+        np.testing.assert_array_equal(table.lookup(xs + offset, ys - offset, rayAngles + 0.4 * 2*pi / def_bins),
+                                      table.lookup(xs, ys, rayAngles))
+        # The headings wrap around
+        np.testing.assert_array_equal(table.lookup(xs, ys, rayAngles - 2*pi), table.lookup(xs, ys, rayAngles))
+
+    def testExpectedDistances(self):
+        svgMap = self.svgMap
+        xs, ys = np.array([[55.], [145.]]), np.array([[35.], [125.]])
+        angles = np.linspace(-pi, pi, def_bins, endpoint=False)[np.newaxis, :] + np.radians(svgMap.north_angle) - pi/2
+
+        cast = svgMap.expectedDistances(xs, ys, angles)
+        svgMap.loadRayTable(def_division, def_bins)
+        np.testing.assert_allclose(svgMap.expectedDistances(xs, ys, angles), cast, rtol=1e-6)
+
+    def testSaveLoad(self):
+        table = RayTable(self.svgMap, def_division, def_bins)
+        path = RayTable.filePath(self.path)
+        self.assertFalse(table.load(path))
+
+        table.build(self.svgMap)
+        table.save(path)
+
+        loaded = RayTable(self.svgMap, def_division, def_bins)
+        self.assertTrue(loaded.load(path))
+        np.testing.assert_array_equal(loaded.distances, table.distances)
+
+        # Another resolution, or other shapes, need another table
+        self.assertFalse(RayTable(self.svgMap, def_division, 2 * def_bins).load(path))
+        self.assertFalse(RayTable(self.svgMap, 2 * def_division, def_bins).load(path))
+        other = RayTable(self.svgMap, def_division, def_bins)
+        other.key = 'another map'
+        self.assertFalse(other.load(path))
+
+    def testPrepare(self):
+        """ prepareRayTable builds the table once, then loads it (without changing the map) """
+        first = self.svgMap.prepareRayTable(def_division, def_bins)
+        self.assertIsNone(self.svgMap.rayTable)
+        self.assertIsNone(first.saveError)
+        self.assertTrue(os.path.exists(RayTable.filePath(self.path)))
+
+        second = self.svgMap.prepareRayTable(def_division, def_bins)
+        np.testing.assert_array_equal(second.distances, first.distances)
+
+    def testUnsavable(self):
+        """ A table that can't be saved is still usable """
+        self.svgMap.path = os.path.join(self.directory, 'missing', 'map.svg')
+        table = self.svgMap.prepareRayTable(def_division, def_bins)
+
+        self.assertIsInstance(table.saveError, (IOError, OSError))
+        self.assertEqual(table.distances.shape, (table.height, table.width, def_bins))
+
+
+if __name__ == "__main__":
+    unittest.main()
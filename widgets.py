@@ -7,6 +7,7 @@ from PySide.QtCore import *
 from PySide.QtGui import *
 
 from math import sin, cos, pi, degrees, radians
+import numpy as np
 from engine import Car
 from probability import ParticleFilter
 
@@ -620,6 +621,9 @@ class GraphicalParticleFilter(QGraphicsObject):
 
     checkmark = QImage('img/check.png')
 
+    # Number of importance levels the particles are drawn with
+    levels = 8
+
     def __init__(self, partFilter):
         super(GraphicalParticleFilter, self).__init__()
         self.setCacheMode( QGraphicsItem.ItemCoordinateCache )
@@ -642,36 +646,65 @@ class GraphicalParticleFilter(QGraphicsObject):
 
     def paint(self, painter=None, style=None, widget=None):
 
-        pen = QPen()
-        pen.setColor(QColor(0, 200, 0))
-        pen.setWidth(10)
-        painter.setPen(pen)
-
-        # Barycenter
-        bX, bY = 0., 0.
-        maxProba = max(particle.p for particle in self.particleFilter.particles)
+        weights = self.particleFilter.weights
+        maxProba = weights.max() if len(weights) > 0 else 0.
 
         bX, bY = self.particleFilter.barycenter.x, self.particleFilter.barycenter.y
 
-        # Drawing the particles
-        for particle in self.particleFilter.particles:
-            # Importance of the particle ranges from 0.0 to 1.0
-            if maxProba == 0.:
-                importance = 0.
-            else:
-                importance = particle.p / maxProba
-            color = QColor.fromHsvF(importance * (0.30), 0.5, 0.8, 0.3)
-            painter.setPen( color )
-            painter.setBrush( color.lighter(0.2) )
-            radius = 3 + importance*8
-            painter.drawEllipse(QPointF(particle.x, particle.y), radius, radius)
-            # painter.drawLine(particle.x, particle.y, bX, bY)
+        # Importance of the particles ranges from 0.0 to 1.0
+        if maxProba == 0.:
+            importances = np.zeros(len(weights))
+        else:
+            importances = weights / maxProba
+        levels = np.minimum((importances * self.levels).astype(int), self.levels - 1)
+
+        # Drawing the particles, by level of importance (each level as round points)
+        for level in xrange(self.levels):
+            selected = np.flatnonzero(levels == level)
+            if len(selected) == 0:
+                continue
+
+            importance = (level + 0.5) / self.levels
+            pen = QPen(QColor.fromHsvF(importance * (0.30), 0.5, 0.8, 0.3))
+            pen.setWidthF(2 * (3 + importance*8))
+            pen.setCapStyle(Qt.RoundCap)
+            painter.setPen(pen)
+
+            xs, ys = self.particleFilter.xs[selected], self.particleFilter.ys[selected]
+            painter.drawPoints(QPolygonF([QPointF(x, y) for x, y in zip(xs, ys)]))
+
+        # Drawing the pose hypotheses : 2-sigma ellipse of their covariance, and their heading
+        north = radians(self.particleFilter.map.north_angle)
+        for hypothesis in self.particleFilter.hypotheses:
+            color = QColor.fromHsvF(0.30 * hypothesis.weight, 0.7, 0.9, 0.3 + 0.6*hypothesis.weight)
+            painter.setPen(QPen(color, 2))
+            painter.setBrush(Qt.NoBrush)
+
+            variances, vectors = np.linalg.eigh(hypothesis.covariance)
+            rx, ry = 2 * np.sqrt(np.maximum(variances, 0.))
+
+            painter.save()
+            painter.translate(hypothesis.x, hypothesis.y)
+            painter.rotate(degrees(np.arctan2(vectors[1, 0], vectors[0, 0])))
+            painter.drawEllipse(QPointF(0, 0), max(rx, 3.), max(ry, 3.))
+            painter.restore()
+
+            heading = hypothesis.angle - north
+            painter.drawLine(QPointF(hypothesis.x, hypothesis.y),
+                             QPointF(hypothesis.x - 30*sin(heading), hypothesis.y - 30*cos(heading)))
 
         color = QColor.fromHsvF(0.5*self.particleFilter.relevance, 0.5, 0.8, 0.8)
         painter.setPen( color.darker(10) )
         painter.setBrush( color )
         painter.drawEllipse(QPointF(bX, bY), 15, 15)
 
+        # Number of particles (none while the Kalman filter tracks the car)
+        painter.setPen(color.lighter(150))
+        if self.particleFilter.ekf is not None:
+            painter.drawText(QPointF(bX + 20, bY + 5), "Kalman tracking")
+        else:
+            painter.drawText(QPointF(bX + 20, bY + 5), "{} particles".format(self.particleFilter.N))
+
         # Drawing the checkmark (if the barycenter is relevant)
         if self.particleFilter.relevance >= ParticleFilter.DecentRelevance:
             painter.drawImage(bX - 8, bY - 8, self.checkmark)